@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import timeit
+import ctypes
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import numpy
+
+from PluginModel import PluginModelFactory, PolydisperseParameter, _as_input_data, c_double_p
+
+LIBRARIES = {
+    'SimpleModel' : 'SimpleModel/libSimpleModel.so',
+    'SphereModel' : 'SphereModel/libSphereModel.so',
+    'SampleModel' : 'SampleModel/libSampleModel.so'}
+
+ENTRIES = {
+    1 : 'calculate_q',
+    2 : 'calculate_qxqy',
+    3 : 'calculate_qxqyqz'}
+
+#################################################################################
+## helpers
+
+def decades(lower, upper): # 10, 100, ... as list of int
+    return [10 ** k for k in xrange(lower, upper + 1)]
+
+def get_commit(): # current git commit (if available) so results can be compared between commits
+    try:
+        directory = os.path.dirname(os.path.realpath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=directory, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_maxrss(): # peak resident set size of this process in KiB (it's never lowered, so it's the peak of all cases run so far)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss
+
+def exports(factory, entry): # True if the loaded library exports "entry" (missing entries are replaced by python defaults)
+    try:
+        factory._cdll[entry]
+        return True
+    except AttributeError:
+        return False
+
+def set_npoints(model, npoints): # replaces all polydisperse parameters by "npoints" evenly weighted points around their default
+    for name in model.model_info.polydisperse:
+        default = model.model_info.get_parameter(name).default
+        model.parameters[name] = PolydisperseParameter(default * numpy.linspace(0.5, 1.5, npoints) if npoints > 1 else numpy.array([default]))
+
+def change_parameter(model): # marks a parameter as changed (the polydisperse one if there is one), so it's packed again by the next calculation
+    info = model.model_info
+    name = info.polydisperse[0] if info.polydisperse else info.parameters[0].name
+    if isinstance(model.parameters[name], PolydisperseParameter):
+        model.parameters[name].touch()
+    else:
+        model.parameters[name] = model.parameters[name]
+
+
+#################################################################################
+## measurements
+
+def measure(factory, model, dimension, nq, npoints, kind, repeat): # returns timings (in seconds) of each stage of a calculation
+    set_npoints(model, npoints)
+    qs = [numpy.linspace(0.001, 0.5, nq) for i in xrange(dimension)]
+    if kind == 'list':
+        qs = [q.tolist() for q in qs]
+
+    function = getattr(factory, '_' + ENTRIES[dimension])
+    cmodel   = factory._created_models[model.id]
+    best     = None
+    factory._get_model_cparameters(model) # the parameter block is built once; calculations only patch changed parameters
+    for i in xrange(repeat):
+        change_parameter(model)
+        t0 = timeit.default_timer()
+        cparameters = factory._get_model_cparameters(model)                          # parameter packing
+        t1 = timeit.default_timer()
+        q_data   = [_as_input_data(q) for q in qs]                                   # buffer conversion
+        iq_owner = numpy.empty(nq) if kind == 'numpy' else (ctypes.c_double * nq)()
+        iq_ptr   = iq_owner.ctypes.data_as(c_double_p) if kind == 'numpy' else iq_owner
+        t2 = timeit.default_timer()
+        function(cmodel, cparameters, nq, iq_ptr, *[q_ptr for q_ptr, n, q_owner in q_data]) # native call
+        t3 = timeit.default_timer()
+        result = iq_owner if kind == 'numpy' else list(iq_owner)                     # result conversion
+        t4 = timeit.default_timer()
+        timings = {'pack': t1 - t0, 'convert': t2 - t1, 'native': t3 - t2, 'result': t4 - t3, 'total': t4 - t0}
+        if (best is None) or (timings['total'] < best['total']):
+            best = timings
+        del result, q_data, iq_owner, iq_ptr
+    return best
+
+def run_library(name, path, args): # runs all measurements for a single library (executed in a separate process); returns (results, skipped entries, peak rss)
+    factory = PluginModelFactory(path)
+    model   = factory.create_model()
+    cases   = [(nq, 1) for nq in args.nq]
+    if model.model_info.polydisperse:
+        cases += [(args.nq_poly, npoints) for npoints in args.npoints if npoints != 1]
+
+    results = []
+    skipped = []
+    for dimension in args.dimensions:
+        entry = ENTRIES[dimension]
+        if not exports(factory, entry):
+            skipped.append(entry)
+            sys.stderr.write('%-12s %-17s skipped (not exported)\n' % (name, entry))
+            continue
+        for nq, npoints in cases:
+            for kind in args.input:
+                timings = measure(factory, model, dimension, nq, npoints, kind, args.repeat)
+                result  = {
+                    'library'   : name,
+                    'entry'     : entry,
+                    'nq'        : nq,
+                    'npoints'   : npoints,
+                    'input'     : kind,
+                    'points_per_second': nq / timings['total'] if timings['total'] > 0.0 else None}
+                result.update(timings)
+                results.append(result)
+                sys.stderr.write('%-12s %-17s nq=%-9i npoints=%-5i %-6s total=%.6fs native=%.6fs\n' % (
+                    name, entry, nq, npoints, kind, timings['total'], timings['native']))
+    return results, skipped, get_maxrss()
+
+def run(args): # runs every library in its own process (a crashing plugin doesn't stop the benchmark and memory is measured per library)
+    results = []
+    skipped = {}
+    maxrss  = {} # library -> peak resident set size (in KiB) of all its cases
+    errors  = {}
+    for name in args.libraries:
+        path = os.path.join(args.build, LIBRARIES[name])
+        if not os.path.exists(path):
+            errors[name] = 'not found: %s' % path
+            continue
+        # results are passed through a file; plugins may write to stdout (which is redirected to stderr)
+        handle, result_path = tempfile.mkstemp(prefix='PluginBenchmark-', suffix='.json')
+        os.close(handle)
+        try:
+            command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ['--build', args.build, '--child', name, '--result-file', result_path]
+            process = subprocess.Popen(command, stdout=sys.stderr)
+            process.wait()
+            if process.returncode != 0:
+                errors[name] = 'exit code %i' % process.returncode
+                continue
+            try:
+                with open(result_path) as f:
+                    output = json.load(f)
+            except ValueError as e:
+                errors[name] = 'invalid output: %s' % e
+                continue
+        finally:
+            os.remove(result_path)
+        results.extend(output['results'])
+        maxrss[name] = output['maxrss_kb']
+        if output['skipped']:
+            skipped[name] = output['skipped']
+
+    return {
+        'commit'    : get_commit(),
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python'    : platform.python_version(),
+        'platform'  : platform.platform(),
+        'results'   : results,
+        'skipped'   : skipped,
+        'maxrss_kb' : maxrss,
+        'errors'    : errors}
+
+def compare(previous, current, threshold): # prints ratios of total time for matching cases; returns number of regressions
+    def key(r):
+        return (r['library'], r['entry'], r['nq'], r['npoints'], r['input'])
+    old = dict((key(r), r) for r in previous['results'])
+    regressions = 0
+    for r in current['results']:
+        o = old.get(key(r))
+        if (o is None) or (o['total'] <= 0.0):
+            continue
+        ratio = r['total'] / o['total']
+        flag  = ' REGRESSION' if ratio > threshold else ''
+        regressions += bool(flag)
+        print '%-12s %-17s nq=%-9i npoints=%-5i %-6s %.3fx%s' % (key(r) + (ratio, flag))
+    return regressions
+
+
+#################################################################################
+## main
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks the plugin call path (packing, conversion, native call and result conversion)')
+    parser.add_argument('--build'     , default=os.getcwd(), help='CMake build directory which holds the plugin libraries (default: current directory)')
+    parser.add_argument('--libraries' , nargs='+', default=sorted(LIBRARIES), choices=sorted(LIBRARIES))
+    parser.add_argument('--dimensions', nargs='+', type=int, default=[1, 2, 3], choices=[1, 2, 3])
+    parser.add_argument('--nq'        , nargs='+', type=int, default=decades(1, 7), help='number of q-values')
+    parser.add_argument('--npoints'   , nargs='+', type=int, default=[1, 10, 100, 1000], help='number of points of polydisperse parameters')
+    parser.add_argument('--nq-poly'   , type=int, default=1000, help='number of q-values used for polydispersity sweep')
+    parser.add_argument('--input'     , nargs='+', default=['list', 'numpy'], choices=['list', 'numpy'])
+    parser.add_argument('--repeat'    , type=int, default=3, help='best of "repeat" runs is reported')
+    parser.add_argument('--output'    , help='writes results as json')
+    parser.add_argument('--compare'   , help='compares results with previous json output')
+    parser.add_argument('--threshold' , type=float, default=1.2, help='ratio of total time which is reported as regression')
+    parser.add_argument('--child'     , help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        results, skipped, maxrss = run_library(args.child, os.path.join(args.build, LIBRARIES[args.child]), args)
+        with open(args.result_file, 'w') as f:
+            json.dump({'results': results, 'skipped': skipped, 'maxrss_kb': maxrss}, f)
+        return 0
+
+    current = run(args)
+    for name, error in sorted(current['errors'].items()):
+        sys.stderr.write('%s failed: %s\n' % (name, error))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            return 1 if compare(json.load(f), current, args.threshold) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
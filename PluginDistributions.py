@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import math
+import numpy
+
+from PluginModel import PolydisperseParameter, ResultCache
+
+#################################################################################
+## helpers
+
+# node/weight tables are independent of the center of a distribution and are therefore shared by all calls
+_tables = ResultCache(16 * 1024 * 1024)
+
+def _get_table(key, generate): # returns cached (nodes, weights) or generates them
+    table = _tables.get(key)
+    if table is None:
+        nodes, weights = generate()
+        weights = weights / weights.sum()
+        nodes.flags.writeable   = False
+        weights.flags.writeable = False
+        table = (nodes, weights)
+        _tables.put(key, table, nodes.nbytes + weights.nbytes)
+    return table
+
+def _create_parameter(values, weights, bounds):
+    if bounds is not None:
+        lower, upper = bounds
+        inside = (values >= lower) & (values <= upper)
+        if not inside.all():
+            values  = values[inside]
+            weights = weights[inside] / weights[inside].sum()
+    return PolydisperseParameter(values, weights)
+
+
+#################################################################################
+## distributions (each returns a PolydisperseParameter whose values and weights are numpy arrays)
+
+def gaussian(center, sigma, npts=35, nsigma=3.0, bounds=None): # "sigma" is the absolute standard deviation
+    nodes, weights = _get_table(('gaussian', npts, nsigma), lambda: (
+        numpy.linspace(-nsigma, nsigma, npts),
+        numpy.exp(-0.5 * numpy.linspace(-nsigma, nsigma, npts) ** 2)))
+    return _create_parameter(center + sigma * nodes, weights, bounds)
+
+def rectangular(center, sigma, npts=35, nsigma=None, bounds=None): # "sigma" is the standard deviation; the half-width is sqrt(3) * sigma
+    nodes, weights = _get_table(('rectangular', npts), lambda: (
+        numpy.linspace(-math.sqrt(3.0), math.sqrt(3.0), npts),
+        numpy.ones(npts)))
+    return _create_parameter(center + sigma * nodes, weights, bounds)
+
+def lognormal(median, sigma, npts=35, nsigma=3.0, bounds=None): # "sigma" is the standard deviation of log(x); nodes are evenly spaced in log(x)
+    nodes, weights = _get_table(('lognormal', npts, nsigma, sigma), lambda: (
+        numpy.exp(sigma * numpy.linspace(-nsigma, nsigma, npts)),
+        numpy.exp(-0.5 * numpy.linspace(-nsigma, nsigma, npts) ** 2)))
+    return _create_parameter(median * nodes, weights, bounds)
+
+def schulz(center, pd, npts=35, nsigma=3.0, bounds=None): # "pd" is the relative polydispersity (sigma / center)
+    def generate():
+        z     = 1.0 / (pd * pd) - 1.0
+        nodes = numpy.linspace(max(1.0 - nsigma * pd, 1.0e-6), 1.0 + nsigma * pd, npts)
+        log_w = z * numpy.log(nodes) - (z + 1.0) * nodes # same shape as SchulzPoint in SampleModel/libSphere.cpp
+        return nodes, numpy.exp(log_w - log_w.max())
+    nodes, weights = _get_table(('schulz', npts, nsigma, pd), generate)
+    return _create_parameter(center * nodes, weights, bounds)
+
+DISTRIBUTIONS = {
+    'gaussian'    : gaussian,
+    'rectangular' : rectangular,
+    'lognormal'   : lognormal,
+    'schulz'      : schulz}
+
+def create(name, center, width, npts=35, nsigma=3.0, bounds=None): # creates distribution by name
+    if not name in DISTRIBUTIONS:
+        raise ValueError(name)
+    return DISTRIBUTIONS[name](center, width, npts, nsigma, bounds)
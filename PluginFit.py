@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import timeit
+import multiprocessing.pool
+
+from PluginModel import numpy, PolydisperseParameter
+
+#################################################################################
+## helpers
+
+def _get_center(value): # value of a fitted parameter (polydisperse parameters are represented by the weighted mean of their values)
+    if isinstance(value, PolydisperseParameter):
+        values  = numpy.asarray(value.values , dtype=numpy.float64)
+        weights = numpy.asarray(value.weights, dtype=numpy.float64)
+        return float(numpy.dot(values, weights) / weights.sum())
+    return float(value)
+
+def get_fittable_names(model_info): # names of parameters which are fitted by default (ordered like ModelInfo.parameters)
+    excluded = set(model_info.unfittable) | set(model_info.integer) | set(model_info.polydisperse)
+    return [p.name for p in model_info.parameters if not p.name in excluded]
+
+
+#################################################################################
+## fitting
+
+class FitResult(object): # outcome of PluginModelFitter.fit
+    # instance
+    def __init__(self, names, values, errors, chisq, dof, iterations, evaluations, calls, success, message, history):
+        self.names       = names       # fitted parameters
+        self.values      = values      # best values (ordered like names)
+        self.errors      = errors      # standard errors from the covariance at the best values
+        self.chisq       = chisq
+        self.dof         = dof         # number of q-values minus number of fitted parameters
+        self.iterations  = iterations
+        self.evaluations = evaluations # number of parameter sets which have been calculated
+        self.calls       = calls       # number of batched calculations
+        self.success     = success
+        self.message     = message
+        self.history     = history     # {'iteration', 'chisq', 'lambda', 'time', 'calculation_time', 'evaluations', 'calls'} of each iteration
+
+    # properties
+    @property
+    def parameters(self): # name -> best value
+        return dict(zip(self.names, self.values))
+
+    @property
+    def reduced_chisq(self):
+        return self.chisq / self.dof if self.dof > 0 else float('nan')
+
+class PluginModelFitter(object): # fits parameters of a PluginModel (or SmearedModel) to measured I(q) by Levenberg-Marquardt; all Jacobian columns are calculated by a single batched call
+    # instance
+    def __init__(self, model, q, iq, diq=None, names=None, bounds=None, distributions=None, threads=1):
+        model_info = model.model_info
+        self.model         = model
+        self.distributions = dict(distributions or {}) # name -> function(center) which returns PolydisperseParameter of a fitted polydisperse parameter
+        self.threads       = threads                   # threads which calculate parameter sets of a batch concurrently (only used for reentrant models)
+        self.step          = 1.0e-6                    # relative step of finite differences (absolute if value is zero)
+        self.damping       = 1.0e-3                    # initial damping of Levenberg-Marquardt
+
+        # unfittable and integer parameters are kept fixed; polydisperse parameters need a distribution
+        if names is None:
+            fittable = set(get_fittable_names(model_info)) | set(self.distributions)
+            names    = [p.name for p in model_info.parameters if p.name in fittable]
+        for name in names:
+            if not name in model_info.index:
+                raise ValueError(name)
+            if (name in model_info.unfittable) or (name in model_info.integer):
+                raise ValueError(name)
+            if (name in model_info.polydisperse) != (name in self.distributions):
+                raise ValueError(name)
+        if not names:
+            raise ValueError('names')
+        self.names = list(names)
+
+        # bounds default to dispmin and dispmax
+        bounds     = bounds or {}
+        self.lower = numpy.array([bounds.get(name, (model_info.get_parameter(name).dispmin, None))[0] for name in self.names], dtype=numpy.float64)
+        self.upper = numpy.array([bounds.get(name, (None, model_info.get_parameter(name).dispmax))[1] for name in self.names], dtype=numpy.float64)
+        self.lower[numpy.isnan(self.lower)] = -numpy.inf
+        self.upper[numpy.isnan(self.upper)] = +numpy.inf
+        if (self.lower > self.upper).any():
+            raise ValueError('bounds')
+
+        # q-values and results are converted once and reused by every calculation
+        self.q  = numpy.ascontiguousarray(q , dtype=numpy.float64)
+        self.iq = numpy.ascontiguousarray(iq, dtype=numpy.float64)
+        if self.iq.shape != self.q.shape:
+            raise ValueError('iq')
+        if diq is None:
+            self.weights = numpy.ones(len(self.q))
+        else:
+            diq = numpy.broadcast_to(numpy.asarray(diq, dtype=numpy.float64), self.q.shape)
+            if (diq <= 0.0).any():
+                raise ValueError('diq')
+            self.weights = 1.0 / diq
+        self.weighted = diq is not None
+
+        self.evaluations = 0 # number of parameter sets which have been calculated
+        self.calls       = 0 # number of batched calculations
+        self.calculation_time = 0.0
+        self._buffer     = numpy.empty((len(self.names) + 1, len(self.q))) # I(q) of all parameter sets of a batch
+        self._pool       = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    # fitting
+    def get_values(self): # current values of fitted parameters
+        return numpy.array([_get_center(self.model.parameters[name]) for name in self.names])
+
+    def set_values(self, values): # assigns values of fitted parameters to model
+        for name, value in zip(self.names, values):
+            self.model.parameters[name] = self._get_value(name, value)
+
+    def fit(self, max_iterations=100, ftol=1.0e-8, xtol=1.0e-8, callback=None): # fits model and assigns best values; callback(info) is called after each iteration
+        evaluations = self.evaluations
+        calls       = self.calls
+        history     = []
+
+        x       = numpy.clip(self.get_values(), self.lower, self.upper)
+        r       = self._get_residuals(self._calculate([x])[0])
+        chisq   = numpy.dot(r, r)
+        damping = self.damping
+        success = False
+        message = 'maximum number of iterations reached'
+        for iteration in xrange(1, max_iterations + 1):
+            started          = timeit.default_timer()
+            calculation_time = self.calculation_time
+            iteration_evaluations = self.evaluations
+            iteration_calls       = self.calls
+
+            # normal equations with Marquardt scaling
+            J = self._get_jacobian(x, r)
+            A = numpy.dot(J.T, J)
+            g = numpy.dot(J.T, r)
+            d = numpy.diag(A).copy()
+            d[d <= 0.0] = 1.0 # parameters without influence
+
+            # damping is increased until a step reduces chisq
+            accepted = False
+            while damping < 1.0e16:
+                try:
+                    delta = numpy.linalg.solve(A + damping * numpy.diag(d), -g)
+                except numpy.linalg.LinAlgError:
+                    damping *= 10.0
+                    continue
+                trial   = numpy.clip(x + delta, self.lower, self.upper) # steps are projected onto bounds
+                r_trial = self._get_residuals(self._calculate([trial])[0])
+                chisq_trial = numpy.dot(r_trial, r_trial)
+                if chisq_trial < chisq:
+                    accepted = True
+                    damping  = max(damping / 10.0, 1.0e-12)
+                    break
+                damping *= 10.0
+
+            info = {
+                'iteration'        : iteration,
+                'chisq'            : chisq_trial if accepted else chisq,
+                'lambda'           : damping,
+                'time'             : timeit.default_timer() - started,
+                'calculation_time' : self.calculation_time - calculation_time,
+                'evaluations'      : self.evaluations - iteration_evaluations,
+                'calls'            : self.calls - iteration_calls}
+            history.append(info)
+            if callback is not None:
+                callback(info)
+
+            if not accepted: # x is a (local) minimum within numerical precision
+                success = True
+                message = 'chisq can not be reduced'
+                break
+            dx = trial - x
+            dchisq = chisq - chisq_trial
+            x, r, chisq = trial, r_trial, chisq_trial
+            if dchisq <= ftol * chisq:
+                success = True
+                message = 'relative reduction of chisq is below ftol'
+                break
+            if (numpy.abs(dx) <= xtol * (numpy.abs(x) + xtol)).all():
+                success = True
+                message = 'relative change of parameters is below xtol'
+                break
+
+        # covariance at best values (scaled by reduced chisq if uncertainties are unknown)
+        dof    = len(self.q) - len(self.names)
+        J      = self._get_jacobian(x, r)
+        errors = numpy.sqrt(numpy.abs(numpy.diag(numpy.linalg.pinv(numpy.dot(J.T, J)))))
+        if (not self.weighted) and (dof > 0):
+            errors *= numpy.sqrt(chisq / dof)
+
+        self.set_values(x)
+        return FitResult(list(self.names), x, errors, chisq, dof, len(history),
+                         self.evaluations - evaluations, self.calls - calls, success, message, history)
+
+    # helper
+    def _get_value(self, name, value):
+        if name in self.distributions:
+            return self.distributions[name](value)
+        return value
+
+    def _get_residuals(self, iq):
+        return (iq - self.iq) * self.weights
+
+    def _get_jacobian(self, x, r): # forward differences of weighted residuals (backward at upper bounds)
+        h = self.step * numpy.where(x != 0.0, numpy.abs(x), 1.0)
+        h = numpy.where(x + h > self.upper, -h, h)
+        points = []
+        for j in xrange(len(x)):
+            point     = x.copy()
+            point[j] += h[j]
+            points.append(point)
+        iq = self._calculate(points)
+        return ((iq - self.iq[None, :]) * self.weights[None, :] - r[None, :]).T / h[None, :]
+
+    def _calculate(self, points): # returns I(q) of every point as rows of the reused buffer; points are calculated by a single batched call (or one per thread)
+        started = timeit.default_timer()
+        m   = len(points)
+        out = self._buffer[:m]
+        parameter_sets = [dict((name, self._get_value(name, value)) for name, value in zip(self.names, point)) for point in points]
+
+        threads = min(self.threads, m) if self.model.model_info.reentrant else 1
+        if threads > 1:
+            if (self._pool is None) or (self._pool._processes != threads):
+                self.close()
+                self._pool = multiprocessing.pool.ThreadPool(threads)
+            limits = numpy.linspace(0, m, threads + 1).astype(int)
+            def calculate(k): # each thread writes into its rows of the buffer
+                self.model.calculate_q_batch(self.q, parameter_sets[limits[k]:limits[k + 1]], out[limits[k]:limits[k + 1]])
+            self._pool.map(calculate, range(threads))
+            self.calls += threads
+        else:
+            self.model.calculate_q_batch(self.q, parameter_sets, out)
+            self.calls += 1
+        self.evaluations      += m
+        self.calculation_time += timeit.default_timer() - started
+        return out
+
+def fit(model, q, iq, diq=None, names=None, bounds=None, distributions=None, threads=1, **options): # fits model once (see PluginModelFitter.fit for options)
+    fitter = PluginModelFitter(model, q, iq, diq, names, bounds, distributions, threads)
+    try:
+        return fitter.fit(**options)
+    finally:
+        fitter.close()
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 
 import os
+import sys
+import copy
+import array
 import struct
 import ctypes
+import timeit
+import hashlib
+import weakref
+import threading
+import collections
+import multiprocessing.pool
 
-API_VERSION = 1
+try:
+    import numpy
+except ImportError: # numpy is optional; lists and other sequences are converted
+    numpy = None
+
+API_VERSION = 2 # version 1 is still supported (it doesn't define model flags)
 
 #################################################################################
 ## helpers
@@ -15,10 +29,9 @@ def enum(*sequential, **named): # is a helper function to create enums
 
 class LibraryHandle(object): # is used to open and close external library
 
-    # # we need to distinguish between windows and other operating systems
-    # import _ctypes
-    # dlopen  = _ctypes.LoadLibrary if os.name in ("nt", "ce") else _ctypes.dlopen
-    # dlclose = _ctypes.FreeLibrary if os.name in ("nt", "ce") else _ctypes.dlclose
+    # we need to distinguish between windows and other operating systems
+    import _ctypes
+    dlclose = _ctypes.FreeLibrary if os.name in ("nt", "ce") else _ctypes.dlclose
 
 
     # instance
@@ -36,12 +49,200 @@ class LibraryHandle(object): # is used to open and close external library
         self.close()
         self.handle = ctypes.CDLL(path)
         
-    def close(self):
+    def close(self): # ctypes never unloads libraries, so the handle is closed explicitly (functions of the library mustn't be used afterwards)
         if self.handle is not None:
-            #handle, self.handle = self.handle, None
-            #LibraryHandle.dlclose(handle)
             handle, self.handle = self.handle, None
-            del handle
+            LibraryHandle.dlclose(handle._handle)
+
+_double_formats = frozenset(['d', '@d', '=d', '<d' if sys.byteorder == 'little' else '>d']) # buffer formats of native doubles
+_byte_formats   = frozenset(['B', 'b', 'c'])                                                 # buffer formats of untyped memory
+
+def _get_buffer_format(data): # returns (format, contiguous) of the buffer exposed by "data" or None
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return None
+    contiguous = getattr(view, 'c_contiguous', None) # not available before python 3.3
+    if contiguous is None:
+        contiguous = True
+        stride     = view.itemsize
+        for size, step in reversed(zip(view.shape or (), view.strides or ())):
+            if (size > 1) and (step != stride):
+                contiguous = False
+            stride *= size
+    return view.format, contiguous
+
+def _as_input_data(data): # returns (pointer, length, owner) for a sequence of doubles; buffers are passed without copying
+    if isinstance(data, ctypes.Array) and data._type_ is ctypes.c_double:
+        return data, len(data), data
+    if isinstance(data, array.array) and data.typecode == 'd':
+        cdata = (ctypes.c_double * len(data)).from_buffer(data)
+        return cdata, len(cdata), cdata
+    if numpy is not None:
+        ndata = data
+        if not isinstance(ndata, numpy.ndarray):
+            info = _get_buffer_format(ndata)
+            if (info is not None) and (info[0] in _double_formats) and info[1]:
+                ndata = numpy.frombuffer(ndata, dtype=numpy.float64)
+            else:
+                ndata = numpy.asarray(ndata, dtype=numpy.float64) # conversion path for lists, other sequences and buffers of other types
+        ndata = numpy.ascontiguousarray(ndata, dtype=numpy.float64).ravel() # only copies if layout or type differ
+        return ndata.ctypes.data_as(c_double_p), ndata.size, ndata
+    # fallback for lists and other sequences (without numpy)
+    n     = len(data)
+    cdata = (ctypes.c_double * n)(*data)
+    return cdata, n, cdata
+
+def _as_output_data(out, n): # returns (pointer, owner) for a caller-supplied, writable buffer of n doubles
+    if isinstance(out, ctypes.Array) and out._type_ is ctypes.c_double:
+        if len(out) != n:
+            raise ValueError('out')
+        return out, out
+    if isinstance(out, array.array) and out.typecode == 'd':
+        if len(out) != n:
+            raise ValueError('out')
+        cdata = (ctypes.c_double * n).from_buffer(out)
+        return cdata, cdata
+    if numpy is None:
+        raise ValueError('out')
+    if not isinstance(out, numpy.ndarray):
+        info = _get_buffer_format(out)
+        if (info is not None) and not (info[0] in _double_formats or info[0] in _byte_formats): # e.g. array of floats or integers
+            raise ValueError('out')
+        out = numpy.frombuffer(out, dtype=numpy.float64)
+    if (out.dtype != numpy.float64) or (out.size != n) or not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError('out')
+    return out.ctypes.data_as(c_double_p), out
+
+def _is_array(data): # True if results should be returned as numpy array
+    return (numpy is not None) and isinstance(data, numpy.ndarray)
+
+def _interpolate(x, nodes, values): # piecewise interpolation of I(q) at "x" (all in log(q)); log(I) is interpolated where I is positive
+    i  = numpy.clip(numpy.searchsorted(nodes, x), 1, len(nodes) - 1)
+    x0 = nodes[i - 1]
+    y0 = values[i - 1]
+    y1 = values[i]
+    t  = (x - x0) / (nodes[i] - x0)
+    with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        logarithmic = y0 * (y1 / y0) ** t
+    return numpy.where((y0 > 0.0) & (y1 > 0.0), logarithmic, y0 + t * (y1 - y0))
+
+def _relative_error(actual, predicted):
+    scale = numpy.maximum(numpy.abs(actual), numpy.finfo(numpy.float64).tiny)
+    return numpy.abs(actual - predicted) / scale
+
+def _insert_nodes(nodes, values, x, y): # adds (x, y) to sorted nodes of interpolation
+    order = numpy.argsort(numpy.concatenate((nodes, x)), kind='mergesort')
+    return numpy.concatenate((nodes, x))[order], numpy.concatenate((values, y))[order]
+
+class _Unlocked(object): # used instead of a lock where calls don't need to be serialized
+    def __enter__(self):
+        pass
+    def __exit__(self, *args):
+        pass
+
+_unlocked = _Unlocked()
+
+class _BoundParameters(object): # handle of parameters which have been bound by external library (see PluginModelFactory._pin_parameters)
+    def __init__(self, buffer, version, handle):
+        self.buffer   = buffer  # parameter block which has been bound
+        self.version  = version # version of parameter block which has been bound
+        self.handle   = handle
+        self.calls    = 0       # number of running calculations which use handle
+        self.replaced = False   # handle is released by the last running calculation
+
+class ResultCache(object): # memoizes results of calculations; least recently used results are evicted if "max_bytes" is exceeded
+    # instance
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size      = 0 # number of bytes held by cached keys and results
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self._entries  = collections.OrderedDict() # key -> (result, size); ordered from least to most recently used
+        self._lock     = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    # access
+    def get(self, key): # returns cached result or None
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result, size):
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+            self._entries[key] = (result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                key, (result, size) = self._entries.popitem(last=False)
+                self.size      -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    # statistics
+    def stats(self):
+        with self._lock:
+            return {
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions,
+                'entries'   : len(self._entries),
+                'size'      : self.size,
+                'max_bytes' : self.max_bytes}
+
+# final intervals of adaptive grids are checked at these fractions of their width; they are accepted if the error is below
+# rtol / ADAPTIVE_SAFETY and the reported error is ADAPTIVE_SAFETY times the largest error found at these points
+ADAPTIVE_CHECKS = (0.145898, 0.381966, 0.618034, 0.854102) # golden sections don't coincide with midpoints of later refinements
+ADAPTIVE_SAFETY = 2.0
+
+# orders of orientation averages (same Gauss-Legendre orders as SampleModel/GaussWeights.h); adaptive averages use them in this sequence
+ORIENTATION_ORDERS = (20, 76, 150)
+
+_orientation_nodes  = {}                             # order -> (ux, uy, uz, weights) of directions on unit sphere
+_orientation_points = ResultCache(64 * 1024 * 1024) # (order, q-digest) -> rotated (qx, qy, qz)
+
+def _get_orientation_nodes(order): # Gauss-Legendre nodes in cos(theta) and "order" evenly spaced nodes in phi; weights sum to one
+    nodes = _orientation_nodes.get(order)
+    if nodes is None:
+        u, wu = numpy.polynomial.legendre.leggauss(order)
+        phi   = (numpy.arange(order) + 0.5) * (2.0 * numpy.pi / order)
+        s     = numpy.sqrt(1.0 - u * u)
+        nodes = (
+            numpy.outer(s, numpy.cos(phi)).ravel(),
+            numpy.outer(s, numpy.sin(phi)).ravel(),
+            numpy.repeat(u, order),
+            numpy.repeat(wu / (2.0 * order), order))
+        for array in nodes:
+            array.flags.writeable = False
+        _orientation_nodes[order] = nodes
+    return nodes
+
+def _get_orientation_points(order, q, cached=True): # returns (qx, qy, qz) of all directions for every q (q-major)
+    if not cached: # e.g. all points of a calculation wouldn't fit into the cache
+        ux, uy, uz, weights = _get_orientation_nodes(order)
+        return tuple(numpy.outer(q, u).ravel() for u in (ux, uy, uz))
+    key    = (order, hashlib.sha1(q).digest())
+    points = _orientation_points.get(key)
+    if points is None:
+        points = _get_orientation_points(order, q, False)
+        _orientation_points.put(key, points, sum(p.nbytes for p in points))
+    return points
 
 
 #################################################################################
@@ -56,6 +257,9 @@ ParameterFlags = enum(
     RepeatCount   = 0x20 | 0x04,
     Repeated      = 0x40)
 
+ModelFlags = enum(
+    Reentrant     = 0x01)
+
 c_double_p = ctypes.POINTER(ctypes.c_double)
 c_cmodel_p = ctypes.c_void_p # pointer to unspecified data which can be used by external library (for each created c-model)
 
@@ -76,7 +280,8 @@ class c_model_info(ctypes.Structure):
         ("name"           , ctypes.c_char_p),
         ("description"    , ctypes.c_char_p),
         ("parameter_count", ctypes.c_size_t),
-        ("parameters"     , c_parameter_info_p)]    
+        ("parameters"     , c_parameter_info_p),
+        ("flags"          , ctypes.c_size_t)]   # since version 2
 c_model_info_p     = ctypes.POINTER(c_model_info)
 
 
@@ -90,25 +295,227 @@ ParameterType = enum(
         
 c_data_p       = ctypes.c_void_p
 c_parameters_p = ctypes.c_void_p
+c_bound_p      = ctypes.c_void_p # handle to parameters which have been parsed by external library (see bind_parameters)
+
+_size_t_format       = 'I' if ctypes.sizeof(ctypes.c_size_t) == 4 else 'Q'
+_header_struct       = struct.Struct('=' + _size_t_format)       # size_t count; or size_t type = ParameterType.End;
+_simple_struct       = struct.Struct('=' + _size_t_format + 'd') # size_t type = ParameterType.Simple; double value;
+_polydisperse_struct = struct.Struct('=' + _size_t_format * 2)   # size_t type = ParameterType.Polydisperse; size_t npoints;
+
+def _pack_doubles(buffer, offset, values): # copies a sequence of doubles into "buffer" (without splatting them into arguments)
+    if (numpy is not None) and isinstance(values, numpy.ndarray):
+        values = numpy.ascontiguousarray(values, dtype=numpy.float64)
+        ctypes.memmove(ctypes.addressof(buffer) + offset, values.ctypes.data, values.nbytes)
+    else:
+        (ctypes.c_double * len(values)).from_buffer(buffer, offset)[:] = values
+
+def _prune_points(values, weights, cutoff, mass): # drops points with small weights; returns (values, weights, dropped mass)
+    if numpy is not None:
+        values  = numpy.asarray(values , dtype=numpy.float64)
+        weights = numpy.asarray(weights, dtype=numpy.float64)
+        total   = weights.sum()
+        if total <= 0.0:
+            return values, weights, 0.0
+        keep = weights >= cutoff * total
+        if mass < 1.0: # keep heaviest points until cumulative mass is reached
+            order = numpy.argsort(-weights, kind='mergesort')
+            count = numpy.searchsorted(numpy.cumsum(weights[order]), mass * total) + 1
+            keep[order[count:]] = False
+        if keep.all():
+            return values, weights, 0.0
+        if not keep.any():
+            keep[numpy.argmax(weights)] = True
+        return values[keep], weights[keep], 1.0 - weights[keep].sum() / total
+
+    total = float(sum(weights))
+    if total <= 0.0:
+        return values, weights, 0.0
+    keep = [w >= cutoff * total for w in weights]
+    if mass < 1.0:
+        cumulative = 0.0
+        for i in sorted(xrange(len(weights)), key=lambda i: -weights[i]):
+            if cumulative >= mass * total:
+                keep[i] = False
+            cumulative += weights[i]
+    if all(keep):
+        return values, weights, 0.0
+    if not any(keep):
+        keep[max(xrange(len(weights)), key=lambda i: weights[i])] = True
+    kept_values  = [v for v, k in zip(values , keep) if k]
+    kept_weights = [w for w, k in zip(weights, keep) if k]
+    return kept_values, kept_weights, 1.0 - sum(kept_weights) / total
+
+class ParameterBlock(object): # packed parameter values (expected by c-model); it's kept by each PluginModel and patched in place
+    # instance
+    def __init__(self, model_info):
+        self.model_info = model_info
+        self.buffer     = None # c-array which holds header and parameter values
+        self.version    = 0    # is incremented whenever the content of buffer changes
+        self.calls      = 0    # number of running calculations which use buffer (it's replaced instead of patched while they run)
+        self.cutoff     = 0.0  # default for PolydisperseParameter.cutoff
+        self.mass       = 1.0  # default for PolydisperseParameter.mass
+        self.dropped    = {}   # name -> fraction of weight which has been dropped from packed polydisperse parameter
+        self._polydisperse = frozenset(model_info.polydisperse)
+        self._points       = {}   # name -> (key, values, weights) of pruned polydisperse parameter
+        self._parameters   = None # collection which has been packed
+        self._layout       = None # number of points for each polydisperse parameter
+        self._offsets      = {}   # name -> offset of parameter (in bytes) within buffer
+        self._versions     = {}   # name -> key of packed PolydisperseParameter
+
+    # packing
+    def pack(self, parameters): # packs all parameters into a new buffer and returns it
+        self._build(parameters, self._get_layout(parameters))
+        return self.buffer
+
+    def update(self, parameters): # patches changed parameters in place (buffer is only rebuilt if its layout changes) and returns buffer
+        dirty  = parameters._get_dirty() # names are only reset once they have been written
+        layout = self._get_layout(parameters)
+        if (parameters is not self._parameters) or (layout != self._layout):
+            self._build(parameters, layout)
+            parameters._reset_dirty(dirty)
+            return self.buffer
+
+        # polydisperse parameters are also tracked by their version and pruning options
+        for name in self.model_info.polydisperse:
+            value = getattr(parameters, name)
+            if isinstance(value, PolydisperseParameter) and (self._get_key(value) != self._versions.get(name)):
+                dirty.add(name)
+
+        if dirty and self.calls: # external functions expect parameters to be unchanged while they use them
+            self._build(parameters, layout)
+        elif dirty:
+            for name in dirty:
+                self._write(name, getattr(parameters, name), self._offsets[name])
+            self.version += 1
+        parameters._reset_dirty(dirty)
+        return self.buffer
+
+    # helper
+    def _get_key(self, value): # identifies the state of a PolydisperseParameter and its pruning options
+        return (
+            value,
+            value.version,
+            value.cutoff if value.cutoff is not None else self.cutoff,
+            value.mass   if value.mass   is not None else self.mass)
+
+    def _get_points(self, name, value): # returns (values, weights) of a PolydisperseParameter after dropping points with small weights
+        key   = self._get_key(value)
+        entry = self._points.get(name)
+        if (entry is None) or (entry[0] != key):
+            if len(value.values) != len(value.weights):
+                raise ValueError(name)
+            cutoff, mass = key[2:]
+            if (cutoff > 0.0) or (mass < 1.0):
+                values, weights, self.dropped[name] = _prune_points(value.values, value.weights, cutoff, mass)
+            else:
+                values, weights, self.dropped[name] = value.values, value.weights, 0.0
+            entry = self._points[name] = (key, values, weights)
+        return entry[1], entry[2]
+
+    def _get_layout(self, parameters): # determines the number of points for each polydisperse parameter
+        layout = []
+        for name in self.model_info.polydisperse:
+            value = getattr(parameters, name)
+            if not isinstance(value, PolydisperseParameter):
+                self._points.pop(name, None)
+                self.dropped[name] = 0.0
+                layout.append(1)
+            else:
+                values, weights = self._get_points(name, value)
+                layout.append(len(values))
+        return tuple(layout)
+
+    def _build(self, parameters, layout):
+        # determine size and offsets
+        npoints   = dict(zip(self.model_info.polydisperse, layout))
+        data_size = 0
+        offsets   = []
+        for p in self.model_info.parameters:
+            offsets.append(data_size)
+            if not p.flags & ParameterFlags.Polydisperse:
+                data_size += _simple_struct.size                                  # size_t type; double value;
+            else:
+                data_size += _polydisperse_struct.size                            # size_t type; size_t npoints;
+                data_size += ctypes.sizeof(ctypes.c_double) * npoints[p.name] * 2 # double values[npoints]; double weights[npoints];
+
+        offsets.append(data_size)
+        data_size += _header_struct.size # size_t type = ParameterType.End;
+
+        # determine header size
+        header_size  = ctypes.sizeof(ctypes.c_size_t)                # size_t count;
+        header_size += ctypes.sizeof(ctypes.c_size_t) * len(offsets) # size_t offsets[count];
+
+        # create buffer and write header
+        buffer = ctypes.create_string_buffer(header_size + data_size)
+        struct.pack_into('=%s%i%s' % (_size_t_format, len(offsets), _size_t_format), buffer, 0, len(offsets), *offsets)
+
+        self.buffer      = buffer
+        self.calls       = 0
+        self._parameters = None # buffer is rebuilt by next update if writing fails
+        self._layout     = layout
+        self._offsets    = dict((p.name, header_size + offset) for p, offset in zip(self.model_info.parameters, offsets))
+        self._versions   = {}
+
+        # write data and end
+        for p in self.model_info.parameters:
+            self._write(p.name, getattr(parameters, p.name), self._offsets[p.name])
+        _header_struct.pack_into(buffer, header_size + offsets[-1], ParameterType.End)
+        self._parameters = parameters
+        self.version += 1
+
+    def _write(self, name, value, offset):
+        if not name in self._polydisperse:
+            _simple_struct.pack_into(self.buffer, offset, ParameterType.Simple, value)
+        elif not isinstance(value, PolydisperseParameter):
+            _polydisperse_struct.pack_into(self.buffer, offset, ParameterType.Polydisperse, 1)
+            _pack_doubles(self.buffer, offset + _polydisperse_struct.size, (value, 1.0))
+        else:
+            values, weights = self._get_points(name, value)
+            npoints         = len(values)
+            _polydisperse_struct.pack_into(self.buffer, offset, ParameterType.Polydisperse, npoints)
+            offset += _polydisperse_struct.size
+            _pack_doubles(self.buffer, offset, values)
+            _pack_doubles(self.buffer, offset + ctypes.sizeof(ctypes.c_double) * npoints, weights)
+            self._versions[name] = self._get_key(value)
 
 #################################################################################
 ## only objects of the following types should be used to access external models
 
-class ModelInfo(object): # describes external model
+class ModelInfo(object): # describes external model; it's decoded once per loaded library and shared by all PluginModels (don't modify it)
+    __slots__ = ('name', 'description', 'parameters', 'flags', 'reentrant', 'index',
+                 'orientation', 'magnetic', 'unfittable', 'integer', 'polydisperse')
+
     # instance
-    def __init__(self, name, description, parameters):
+    def __init__(self, name, description, parameters, flags=0):
         self.name        = name
         self.description = description
-        self.parameters  = parameters # list of ParameterInfo
-
-        # the following lists define the type of the parameters 
-        self.orientation  = [p.name for p in parameters if p.flags & ParameterFlags.Orientation ]
-        self.magnetic     = [p.name for p in parameters if p.flags & ParameterFlags.Magnetic    ]
-        self.unfittable   = [p.name for p in parameters if p.flags & ParameterFlags.Unfittable  ]
-        self.integer      = [p.name for p in parameters if p.flags & ParameterFlags.Integer     ]
-        self.polydisperse = [p.name for p in parameters if p.flags & ParameterFlags.Polydisperse]
+        self.parameters  = tuple(parameters) # tuple of ParameterInfo
+        self.flags       = flags
+
+        # calculations of reentrant models can be split and executed concurrently
+        self.reentrant    = (flags & ModelFlags.Reentrant) != 0
+
+        # name -> position within parameters
+        self.index        = dict((p.name, i) for i, p in enumerate(self.parameters))
+
+        # the following tuples define the type of the parameters 
+        self.orientation  = tuple(p.name for p in self.parameters if p.flags & ParameterFlags.Orientation )
+        self.magnetic     = tuple(p.name for p in self.parameters if p.flags & ParameterFlags.Magnetic    )
+        self.unfittable   = tuple(p.name for p in self.parameters if p.flags & ParameterFlags.Unfittable  )
+        self.integer      = tuple(p.name for p in self.parameters if p.flags & ParameterFlags.Integer     )
+        self.polydisperse = tuple(p.name for p in self.parameters if p.flags & ParameterFlags.Polydisperse)
+
+    # pickling (classes with __slots__ can't be pickled by protocols 0 and 1 otherwise); derived attributes are recomputed
+    def __reduce__(self):
+        return (ModelInfo, (self.name, self.description, self.parameters, self.flags))
+
+    # parameters
+    def get_parameter(self, name): # returns ParameterInfo of parameter "name"
+        return self.parameters[self.index[name]]
         
 class ParameterInfo(object): # ModelInfo.parameters contains ParameterInfo for each parameter
+    __slots__ = ('name', 'description', 'unit', 'default', 'dispmin', 'dispmax', 'flags')
+
     # instance
     def __init__(self, name, description, unit, default, dispmin, dispmax, flags):
         self.name        = name
@@ -118,14 +525,25 @@ class ParameterInfo(object): # ModelInfo.parameters contains ParameterInfo for e
         self.dispmin     = dispmin
         self.dispmax     = dispmax
         self.flags       = flags
+
+    # pickling
+    def __reduce__(self):
+        return (ParameterInfo, (self.name, self.description, self.unit, self.default, self.dispmin, self.dispmax, self.flags))
        
 class PluginModel(object): # represents a concrete model with all its parameters. It's used for simulations.
     # instance
-    def __init__(self, factory, id, model_info, parameters):
+    def __init__(self, factory, id, model_info, parameters, data=None):
         self.factory    = factory    # factory object which created this PluginModel
         self.id         = id         # instance id
+        self.data       = data       # data which has been passed to create_model (it's part of the keys of cached results)
         self.model_info = model_info # should be of type ModelInfo
         self.parameters = parameters # instance of PluginModelParameterCollection
+        self.parameter_block = None  # ParameterBlock which is kept up to date with parameters (created on first calculation)
+        # defaults for dropping points of polydisperse parameters with small weights
+        self.cutoff     = 0.0
+        self.mass       = 1.0
+        self.adaptive_info = None    # error estimate and number of evaluations of last adaptive calculation
+        self.average_info  = None    # order and error estimate of last orientation average
 
     def __del__(self):
         self.destroy()
@@ -134,19 +552,51 @@ class PluginModel(object): # represents a concrete model with all its parameters
     def get_model_info(self):
         return self.model_info
         
+    def get_dropped_mass(self): # returns fraction of weight which has been dropped from each polydisperse parameter by last calculation
+        if self.parameter_block is None:
+            return {}
+        return dict(self.parameter_block.dropped)
+
+    def get_adaptive_info(self): # returns {'error', 'evaluations', 'points'} of last calculate_q(..., rtol=...)
+        return dict(self.adaptive_info) if self.adaptive_info is not None else {}
+
+    def get_average_info(self): # returns {'order', 'error', 'points'} of last calculate_q_average
+        return dict(self.average_info) if self.average_info is not None else {}
+
     # model instantiation
     def destroy(self):
         self.factory.destroy_model(self)
 
     # calculations
-    def calculate_q(self, q):
-        return self.factory.calculate_q(self, q)
+    def calculate_q(self, q, out=None, rtol=None): # if "rtol" is set then I(q) is interpolated from an adaptively refined grid
+        if rtol is not None:
+            return self.factory.calculate_q_adaptive(self, q, rtol, out)
+        return self.factory.calculate_q(self, q, out)
         
-    def calculate_qxqy(self, qx, qy):
-        return self.factory.calculate_qxqy(self, qx, qy)
+    def calculate_qxqy(self, qx, qy, out=None):
+        return self.factory.calculate_qxqy(self, qx, qy, out)
         
-    def calculate_qxqyqz(self, qx, qy, qz):
-        return self.factory.calculate_qxqyqz(self, qx, qy, qz)
+    def calculate_qxqyqz(self, qx, qy, qz, out=None):
+        return self.factory.calculate_qxqyqz(self, qx, qy, qz, out)
+
+    def calculate_q_batch(self, q, parameter_sets, out=None):
+        return self.factory.calculate_q_batch(self, q, parameter_sets, out)
+
+    def calculate_q_average(self, q, order=76, rtol=None, out=None): # I(q) averaged over all orientations (see ORIENTATION_ORDERS)
+        return self.factory.calculate_q_average(self, q, order, rtol, out)
+
+    def calculate_stream(self, qs, out, chunk_size=None):
+        return self.factory.calculate_stream(self, qs, out, chunk_size)
+
+    # asynchronous calculations (return Future, see PluginModelAsync)
+    def calculate_q_async(self, q):
+        return self.factory.calculate_async(self, 'calculate_q', (q,))
+
+    def calculate_qxqy_async(self, qx, qy):
+        return self.factory.calculate_async(self, 'calculate_qxqy', (qx, qy))
+
+    def calculate_qxqyqz_async(self, qx, qy, qz):
+        return self.factory.calculate_async(self, 'calculate_qxqyqz', (qx, qy, qz))
         
     def calculate_ER(self):
         return self.factory.calculate_ER(self)
@@ -157,42 +607,118 @@ class PluginModel(object): # represents a concrete model with all its parameters
 class PluginModelParameterCollection(object): # allows access to parameters either as PluginModel.parameters.name or PluginModel.parameters["name"]
     # instance
     def __init__(self, parameters):
-        self.__dict__.update(parameters)        
+        object.__setattr__(self, '_values', dict(parameters))
+        object.__setattr__(self, '_dirty' , set(parameters)) # names of parameters which have been changed since last packing
     def __len__(self):
-        return len(self.__dict__)
+        return len(self._values)
     def __getattr__(self, name):
-        return self.__dict__[name]
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(name)
     def __setattr__(self, name, value):
-        if not name in self.__dict__:
+        if not name in self._values:
             raise AttributeError(name)
-        self.__dict__[name] = value
+        self._values[name] = value
+        self._dirty.add(name)
     def __delattr__(self, name):
         raise Exception()
     def __getitem__(self, name):
-        return self.__dict__[name]
+        return self._values[name]
     def __setitem__(self, name, value):
-        if not name in self.__dict__:
+        if not name in self._values:
             raise AttributeError(name)
-        self.__dict__[name] = value
+        self._values[name] = value
+        self._dirty.add(name)
     def __iter__(self):
-        return iter(self.__dict__)
+        return iter(self._values)
+
+    # copies and pickles don't share values or change tracking with the original (all their parameters have to be packed)
+    def __copy__(self):
+        return PluginModelParameterCollection(self._values)
+    def __deepcopy__(self, memo):
+        return PluginModelParameterCollection(copy.deepcopy(self._values, memo))
+    def __getstate__(self):
+        return dict(self._values)
+    def __setstate__(self, state):
+        object.__setattr__(self, '_values', dict(state))
+        object.__setattr__(self, '_dirty' , set(state))
+
+    # change tracking
+    def _get_dirty(self): # returns names of parameters which have been changed since last packing
+        return set(self._dirty)
+
+    def _reset_dirty(self, names): # is called once "names" have been packed
+        self._dirty.difference_update(names)
     
+class _FrozenList(list): # list which can't be modified in place
+    def _readonly(self, *args):
+        raise TypeError('values and weights of PolydisperseParameter have to be assigned')
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _readonly
+    append = extend = insert = pop = remove = reverse = sort = _readonly
+
+    def __reduce__(self): # copies and pickles are ordinary lists
+        return (list, (list(self),))
+
+def _freeze(values): # returns read-only copy of values or weights (packed parameters only track assignments, not in-place modifications)
+    if _is_array(values):
+        values = numpy.array(values, dtype=numpy.float64)
+        if values.ndim != 1: # points are packed by size, so they mustn't exceed the space of len(values) doubles
+            raise ValueError('values')
+        values.flags.writeable = False
+        return values
+    return _FrozenList(values)
+
 class PolydisperseParameter(object): # if a parameter is flagged as polydisperse then PluginModel.parameters.x will have "values" and "weights" attributes
     # instance
-    def __init__(self, values, weights=None):
-        self.values = values
+    def __init__(self, values, weights=None, cutoff=None, mass=None):
+        self.version = 0      # is incremented whenever values or weights are assigned (they are copied and can't be modified in place)
+        self.cutoff  = cutoff # points whose normalized weight is below cutoff are not passed to c-model (None means PluginModel.cutoff)
+        self.mass    = mass   # only the heaviest points which make up this fraction of total weight are passed to c-model (None means PluginModel.mass)
+        self.values  = values
         if weights is not None:
             self.weights = weights
+        elif _is_array(values):
+            self.weights = numpy.full(len(values), 1.0 / len(values))
         else:
             w = 1.0 / len(values)
             self.weights = [w for v in values]
 
+    # properties
+    def _get_values(self):
+        return self._values
+    def _set_values(self, values):
+        self._values  = _freeze(values)
+        self.version += 1
+    def _get_weights(self):
+        return self._weights
+    def _set_weights(self, weights):
+        self._weights = _freeze(weights)
+        self.version += 1
+    values  = property(_get_values , _set_values )
+    weights = property(_get_weights, _set_weights)
+
+    def __setstate__(self, state): # copies and pickles are frozen again
+        self.__dict__.update(state)
+        self._values  = _freeze(self._values)
+        self._weights = _freeze(self._weights)
+
+    # change tracking
+    def touch(self): # forces the parameter to be packed again
+        self.version += 1
+
+def _create_default_parameters(model_info): # returns PluginModelParameterCollection which holds default values
+    return PluginModelParameterCollection({
+        p.name : (p.default if not p.flags & ParameterFlags.Polydisperse else PolydisperseParameter([p.default]))
+        for p in model_info.parameters})
+
 class PluginModelFactory(object): # does the hard work
 
     # instance
     def __init__(self, path=None):
         # library
         self.path      = None               # path to loaded external library
+        self._library  = None               # (path, modification time, size) of loaded library (identifies its build in keys of cached results)
         self._modelLib = LibraryHandle()    # handle to external library
         self._cdll     = None               # helper object which provides access to external methods for loaded library
         # functions
@@ -204,6 +730,33 @@ class PluginModelFactory(object): # does the hard work
         self._calculate_qxqyqz = None
         self._calculate_ER     = None
         self._calculate_VR     = None
+        # optional functions
+        self._calculate_q_many   = None
+        self._bind_parameters    = None
+        self._calculate_q_bound  = None
+        self._release_parameters = None
+        self._bound_parameters   = {} # id -> _BoundParameters of model's parameter block
+        # model information (decoded once per loaded library)
+        self._model_info = None
+        # parallel calculations (only used for reentrant models)
+        self.threads     = 1                # number of threads used to calculate I(q); 1 means serial mode
+        self.chunk_size  = 32768            # number of q-values which are calculated by a single thread at once
+        self._pool       = None             # thread pool (created on demand)
+        self._pool_size  = 0
+        self.backend     = None             # optional execution backend which calculates I(q) instead (e.g. PluginModelPool.PluginModelProcessPool)
+        self.dispatcher  = None             # PluginModelAsync.PluginModelDispatcher used by calculate_*_async (created on demand)
+        self._dispatcher_lock = threading.Lock()
+        self._lock       = threading.RLock() # serializes patching of parameter blocks and calls of models which aren't reentrant
+        # memoization
+        self.cache       = None             # optional ResultCache (results are keyed by library build, data of create_model, parameter values and q-values)
+        # isotropic models (without orientation parameters) calculate I(qx, qy) as I(|q|)
+        self.isotropic           = True     # enables evaluation of calculate_qxqy once per unique |q|
+        self.isotropic_tolerance = None     # if set, |q| is rounded to multiples of this tolerance before duplicates are removed
+        self.adaptive_nodes      = 64       # number of log-spaced q-values of initial grid used by calculate_q_adaptive
+        # statistics (disabled by default)
+        self._stats          = None         # (model name, entry) -> [calls, points, pack time, conversion time, native time, cache hits]
+        self._stats_callback = None
+        self._stats_lock     = threading.Lock()
         # created models
         self._next_model_id  = 1            # every model created will get a new id
         self._created_models = {}           # id -> c-model (used to allow us to unload current library on demand)
@@ -214,6 +767,8 @@ class PluginModelFactory(object): # does the hard work
  
     def __del__(self):
         self.unload()
+        if self._pool is not None:
+            self._pool.close()
         
     # load and unload library
     def load(self, path):
@@ -227,7 +782,10 @@ class PluginModelFactory(object): # does the hard work
         self._cdll = self._modelLib.handle
         self.path  = path
         try:
-            def loadfunction(cdll, name, restype, argtypes, default=None):
+            stat = os.stat(path) # results of an earlier build at the same path mustn't be used
+            self._library = (path, stat.st_mtime, stat.st_size)
+
+            def loadfunction(cdll, name, restype, argtypes, default=None, optional=False):
                 try:
                     f = cdll[name]
                     f.restype  = restype
@@ -236,6 +794,8 @@ class PluginModelFactory(object): # does the hard work
                 except:
                     if default:
                         return default
+                    if optional:
+                        return None
                     raise
 
             def default_create_model(data):
@@ -259,6 +819,19 @@ class PluginModelFactory(object): # does the hard work
             # other calculations
             self._calculate_ER     = loadfunction(self._cdll, 'calculate_ER'    , ctypes.c_double, [c_cmodel_p, c_parameters_p])
             self._calculate_VR     = loadfunction(self._cdll, 'calculate_VR'    , ctypes.c_double, [c_cmodel_p, c_parameters_p])
+            # optional extensions
+            self._calculate_q_many = loadfunction(self._cdll, 'calculate_q_many', None, [c_cmodel_p, ctypes.c_size_t, ctypes.POINTER(c_parameters_p), ctypes.c_size_t, c_double_p, c_double_p], optional=True)
+            # prepared parameters are only used if all functions are exported
+            bind_parameters    = loadfunction(self._cdll, 'bind_parameters'   , c_bound_p, [c_cmodel_p, c_parameters_p], optional=True)
+            calculate_q_bound  = loadfunction(self._cdll, 'calculate_q_bound' , None     , [c_bound_p, ctypes.c_size_t, c_double_p, c_double_p], optional=True)
+            release_parameters = loadfunction(self._cdll, 'release_parameters', None     , [c_bound_p], optional=True)
+            if None not in (bind_parameters, calculate_q_bound, release_parameters):
+                self._bind_parameters    = bind_parameters
+                self._calculate_q_bound  = calculate_q_bound
+                self._release_parameters = release_parameters
+
+            # decode model info
+            self._model_info = self._decode_model_info()
         except:
             try:
                 self.unload()
@@ -267,7 +840,13 @@ class PluginModelFactory(object): # does the hard work
             raise
         
     def unload(self):
-        # destroy existing c-models
+        # stop asynchronous calculations
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+            self.dispatcher = None
+        # release bound parameters and destroy existing c-models
+        for id in self._bound_parameters.keys():
+            self._release_bound_parameters(id)
         if self._destroy_model is not None:
             for cmodel in self._created_models.itervalues():
                 self._destroy_model(cmodel)
@@ -281,16 +860,27 @@ class PluginModelFactory(object): # does the hard work
         self._calculate_qxqyqz = None
         self._calculate_ER     = None
         self._calculate_VR     = None
+        self._calculate_q_many = None
+        self._bind_parameters    = None
+        self._calculate_q_bound  = None
+        self._release_parameters = None
+        self._model_info       = None
         # close library
         self._modelLib.close()
         self._cdll = None
         self.path  = None
+        self._library = None
 
     # model information
-    def get_model_info(self): # generates an instance of ModelInfo
+    def get_model_info(self): # returns ModelInfo of loaded library (it's shared by all created models)
+        if self._model_info is None:
+            raise Exception()
+        return self._model_info
+
+    def _decode_model_info(self): # generates an instance of ModelInfo
         # get model info
         cmi = self._get_model_info().contents
-        if cmi.version != API_VERSION:
+        if not 1 <= cmi.version <= API_VERSION:
             raise Exception()
 
         # get parameter info
@@ -309,12 +899,16 @@ class PluginModelFactory(object): # does the hard work
         return ModelInfo(
             cmi.name,
             cmi.description,
-            parameters)
+            parameters,
+            cmi.flags if cmi.version >= 2 else 0)
 
     # model instantiation
     def create_model(self, data=None): # creates a concrete model (PluginModel) which can have an individual set of parameter values
+        # "data" is passed as pointer: None, a string or a ctypes object. numbers are rejected, since they would be passed as addresses
         if self._create_model is None:
             raise Exception()
+        if isinstance(data, (bool, int, long, float)):
+            raise ValueError('data')
 
         # increment id
         current_id          = self._next_model_id
@@ -323,12 +917,8 @@ class PluginModelFactory(object): # does the hard work
         # create cmodel
         self._created_models[current_id] = self._create_model(data)
 
-        model_info         = self.get_model_info()
-        default_parameters = PluginModelParameterCollection({
-            p.name : (p.default if not p.flags & ParameterFlags.Polydisperse else PolydisperseParameter([p.default]))
-            for p in model_info.parameters})
-
-        return PluginModel(self, current_id, model_info, default_parameters)
+        model_info = self._model_info
+        return PluginModel(self, current_id, model_info, _create_default_parameters(model_info), data)
         
     def destroy_model(self, model): # destroys a concrete model
         if not model.id in self._created_models:
@@ -337,6 +927,7 @@ class PluginModelFactory(object): # does the hard work
             raise Exception()
         
         try:
+            self._release_bound_parameters(model.id)
             cmodel = self._created_models[model.id]
             self._destroy_model(cmodel)
         finally:
@@ -345,163 +936,531 @@ class PluginModelFactory(object): # does the hard work
             model.factory    = None
             model.model_info = None
             model.parameters = None
+            model.parameter_block = None
         
     # helper
     def _get_cparameters(self, model_info, parameters): # creates a c-array which holds parameter values (expected by c-model)
-        is32bit = ctypes.sizeof(ctypes.c_size_t) == 4
+        return ParameterBlock(model_info).pack(parameters)
 
-        # determine size and offsets
-        data_size = 0
-        offsets   = []
-        for p in model_info.parameters:
-            offsets.append(data_size)
-            if not p.flags & ParameterFlags.Polydisperse:
-                data_size += ctypes.sizeof(ctypes.c_size_t) # size_t type = ParameterType.Simple;
-                data_size += ctypes.sizeof(ctypes.c_double) # double value;
-            else:
-                values_weights = getattr(parameters, p.name)
-                if isinstance(values_weights, (int, long, float)):
-                    npoints = 1
-                else:
-                    npoints = len(values_weights.values)
-                
-                data_size += ctypes.sizeof(ctypes.c_size_t)            # size_t type = ParameterType.Polydisperse;
-                data_size += ctypes.sizeof(ctypes.c_size_t)            # size_t npoints;
-                data_size += ctypes.sizeof(ctypes.c_double) * npoints  # double values[npoints];
-                data_size += ctypes.sizeof(ctypes.c_double) * npoints  # double weights[npoints];
-
-        offsets.append(data_size)
-        data_size += ctypes.sizeof(ctypes.c_size_t) # size_t type = ParameterType.End;
+    def _get_model_cparameters(self, model): # returns c-array of model which is only patched where parameter values have changed
+        with self._lock: # blocks are also patched by callers of calculate_*_async
+            block = model.parameter_block
+            if block is None:
+                block = model.parameter_block = ParameterBlock(model.model_info)
+            block.cutoff = model.cutoff
+            block.mass   = model.mass
+            return block.update(model.parameters)
 
-        # determine header size
-        header_size  = ctypes.sizeof(ctypes.c_size_t)                # size_t count;
-        header_size += ctypes.sizeof(ctypes.c_size_t) * len(offsets) # size_t offsets[count];
-
-        # create buffer
-        buffer = ctypes.create_string_buffer(header_size + data_size)
-        # write header
-        if is32bit:
-            struct.pack_into('I%iI' % len(offsets), buffer, 0, len(offsets), *offsets)
-        else:
-            struct.pack_into('Q%iQ' % len(offsets), buffer, 0, len(offsets), *offsets)
-        # wrtie data
-        offset = header_size
-        for p in model_info.parameters:
-            if not p.flags & ParameterFlags.Polydisperse:
-                if is32bit:
-                    struct.pack_into('I', buffer, offset, ParameterType.Simple)
-                else:
-                    struct.pack_into('Q', buffer, offset, ParameterType.Simple)
-                offset += ctypes.sizeof(ctypes.c_size_t) # size_t type = ParameterType.Simple;
-
-                struct.pack_into('=d', buffer, offset, getattr(parameters, p.name))
-                offset += ctypes.sizeof(ctypes.c_double) # double value;
-            else:
-                values_weights = getattr(parameters, p.name)
-                is_single      = isinstance(values_weights, (int, long, float))
-                if is_single:
-                    npoints = 1
-                else:
-                    npoints = len(values_weights.values)
-
-                if is32bit:
-                    struct.pack_into('II', buffer, offset, ParameterType.Polydisperse, npoints)
-                else:
-                    struct.pack_into('QQ', buffer, offset, ParameterType.Polydisperse, npoints)
-                offset += ctypes.sizeof(ctypes.c_size_t) # size_t type = ParameterType.Polydisperse;
-                offset += ctypes.sizeof(ctypes.c_size_t) # size_t npoints;
-
-                if is_single:
-                    struct.pack_into('=dd', buffer, offset, values_weights, 1.0)
-                    offset += ctypes.sizeof(ctypes.c_double)            # double values[1];
-                    offset += ctypes.sizeof(ctypes.c_double)            # double weights[1];
-                else:
-                    format = '=%id' % npoints
-                    struct.pack_into(format, buffer, offset, *values_weights.values)
-                    offset += ctypes.sizeof(ctypes.c_double) * npoints  # double values[npoints];
-                    
-                    struct.pack_into(format, buffer, offset, *values_weights.weights)
-                    offset += ctypes.sizeof(ctypes.c_double) * npoints  # double weights[npoints];
-                
-        # write end
-        if is32bit:
-            struct.pack_into('I', buffer, offset, ParameterType.End)
-        else:
-            struct.pack_into('Q', buffer, offset, ParameterType.End)
-
-        return buffer
+    def _get_lock(self, model): # returns lock which has to be held while external functions are called for model
+        # c-models which aren't reentrant may be modified by calculations (e.g. SampleModel), which can be called by several threads
+        return _unlocked if model.model_info.reentrant else self._lock
     
     # I/Q calculations
-    def calculate_q(self, model, q):
+    def calculate_q(self, model, q, out=None):
         if not model.id in self._created_models:
             raise ValueError('model.id')
         if self._calculate_q is None:
             raise Exception()
 
+        started     = timeit.default_timer() if self._stats is not None else None
         cmodel      = self._created_models[model.id]
-        cparameters = self._get_cparameters(model.model_info, model.parameters)
+        cparameters = self._get_model_cparameters(model)
         
         if q is None:
-            self._calculate_q(cmodel, cparameters, 0, None, None)
+            with self._get_lock(model):
+                self._calculate_q(cmodel, cparameters, 0, None, None)
             return []
 
-        n       = len(q)
-        iq_data = (ctypes.c_double * n)()
-        q_data  = (ctypes.c_double * n)(*q)
-        self._calculate_q(cmodel, cparameters, n, iq_data, q_data)
-        return list(iq_data)
+        return self._calculate_iq('calculate_q', model, cmodel, cparameters, (q,), out, started)
         
-    def calculate_qxqy(self, model, qx, qy):
+    def calculate_qxqy(self, model, qx, qy, out=None):
         if not model.id in self._created_models:
             raise ValueError('model.id')
         if self._calculate_qxqy is None:
             raise Exception()
 
+        started     = timeit.default_timer() if self._stats is not None else None
         cmodel      = self._created_models[model.id]
-        cparameters = self._get_cparameters(model.model_info, model.parameters)
+        cparameters = self._get_model_cparameters(model)
 
         if (qx is None) or (qy is None):
-            self._calculate_qxqy(cmodel, cparameters, 0, None, None, None)
+            with self._get_lock(model):
+                self._calculate_qxqy(cmodel, cparameters, 0, None, None, None)
             return []
 
-        nx = len(qx)
-        ny = len(qy)
-        if nx != ny:
-            raise Exception()
-        
-        n = nx
-        iq_data = (ctypes.c_double * n)()
-        qx_data = (ctypes.c_double * n)(*qx)
-        qy_data = (ctypes.c_double * n)(*qy)
-        self._calculate_qxqy(cmodel, cparameters, n, iq_data, qx_data, qy_data)
-        return list(iq_data)
+        if self.isotropic and not model.model_info.orientation:
+            return self._calculate_isotropic(model, cmodel, cparameters, qx, qy, out, started)
+
+        return self._calculate_iq('calculate_qxqy', model, cmodel, cparameters, (qx, qy), out, started)
         
-    def calculate_qxqyqz(self, model, qx, qy, qz):
+    def calculate_qxqyqz(self, model, qx, qy, qz, out=None):
         if not model.id in self._created_models:
             raise ValueError('model.id')
         if self._calculate_qxqyqz is None:
             raise Exception()
 
+        started     = timeit.default_timer() if self._stats is not None else None
         cmodel      = self._created_models[model.id]
-        cparameters = self._get_cparameters(model.model_info, model.parameters)
+        cparameters = self._get_model_cparameters(model)
 
         if (qx is None) or (qy is None) or (qz is None):
-            self._calculate_qxqyqz(cmodel, cparameters, 0, None, None, None, None)
+            with self._get_lock(model):
+                self._calculate_qxqyqz(cmodel, cparameters, 0, None, None, None, None)
             return []
 
-        nx = len(qx)
-        ny = len(qy)
-        nz = len(qz)
-        if (nx != ny) or (nx != nz):
+        return self._calculate_iq('calculate_qxqyqz', model, cmodel, cparameters, (qx, qy, qz), out, started)
+
+    def calculate_q_adaptive(self, model, q, rtol, out=None): # interpolates I(q) from a log-spaced grid which is refined until the local error is below "rtol"
+        if numpy is None:
+            raise Exception('calculate_q_adaptive requires numpy')
+        if rtol <= 0.0:
+            raise ValueError('rtol')
+
+        q_ptr, n, q_owner = _as_input_data(q)
+        q_all   = numpy.asarray(q_owner, dtype=numpy.float64)
+        targets = numpy.unique(q_all)
+        info    = {'error': 0.0, 'evaluations': 0, 'points': n}
+        result  = numpy.empty(n)
+
+        # q <= 0 can't be placed on a log-grid and is calculated directly
+        direct = q_all <= 0.0
+        if direct.any():
+            result[direct] = self.calculate_q(model, q_all[direct])
+            info['evaluations'] += int(direct.sum())
+        targets = numpy.log(targets[targets > 0.0])
+
+        if len(targets) <= 2 * self.adaptive_nodes: # a grid doesn't save anything
+            nodes  = targets
+            values = numpy.asarray(self.calculate_q(model, numpy.exp(nodes)))
+            info['evaluations'] += len(nodes)
+        else:
+            nodes  = numpy.linspace(targets[0], targets[-1], self.adaptive_nodes)
+            values = numpy.asarray(self.calculate_q(model, numpy.exp(nodes)))
+            info['evaluations'] += len(nodes)
+
+            # intervals are split at their midpoint until it's predicted within "rtol" (e.g. near minima of oscillations).
+            # a midpoint can coincide with the model by chance (e.g. ripples of polydisperse models), so the final interpolant of
+            # converged intervals is checked at ADAPTIVE_CHECKS; intervals which fail are refined again.
+            budget  = len(targets) # grid doesn't need to be finer than the requested q-values
+            lower   = nodes[:-1]
+            upper   = nodes[1:]
+            checked = (numpy.empty(0), numpy.empty(0))
+            while (len(lower) or len(checked[0])) and info['evaluations'] < budget:
+                lower, upper = self._get_inside(targets, lower, upper)
+                if len(lower):
+                    middle    = 0.5 * (lower + upper)
+                    predicted = _interpolate(middle, nodes, values)
+                    actual    = numpy.asarray(self.calculate_q(model, numpy.exp(middle)))
+                    info['evaluations'] += len(middle)
+                    error  = _relative_error(actual, predicted)
+                    nodes, values = _insert_nodes(nodes, values, middle, actual)
+
+                    refine  = error > rtol
+                    checked = (
+                        numpy.concatenate((checked[0], lower[~refine], middle[~refine])),
+                        numpy.concatenate((checked[1], middle[~refine], upper[~refine])))
+                    lower = numpy.concatenate((lower[refine], middle[refine]))
+                    upper = numpy.concatenate((middle[refine], upper[refine]))
+                    if len(lower) and info['evaluations'] < budget:
+                        continue
+                    if len(lower): # grid is as fine as requested q-values; the error of the coarser interpolant is kept
+                        info['error'] = max(info['error'], float(error[refine].max()))
+
+                # check final interpolant of converged intervals (they haven't been changed since)
+                check_lower, check_upper = self._get_inside(targets, *checked)
+                checked = (numpy.empty(0), numpy.empty(0))
+                if not len(check_lower):
+                    continue
+                points    = check_lower + numpy.outer(ADAPTIVE_CHECKS, check_upper - check_lower) # one column per interval
+                predicted = _interpolate(points.ravel(), nodes, values)
+                actual    = numpy.asarray(self.calculate_q(model, numpy.exp(points.ravel())))
+                info['evaluations'] += points.size
+                error  = _relative_error(actual, predicted).reshape(points.shape).max(axis=0)
+                failed = error > rtol / ADAPTIVE_SAFETY
+                if (~failed).any():
+                    info['error'] = max(info['error'], ADAPTIVE_SAFETY * float(error[~failed].max()))
+                if failed.any() and info['evaluations'] >= budget:
+                    info['error'] = max(info['error'], float(error[failed].max()))
+                # failed intervals are split at all points
+                split = numpy.vstack((check_lower[failed], points[:, failed], check_upper[failed]))
+                nodes, values = _insert_nodes(nodes, values, points[:, failed].ravel(), actual.reshape(points.shape)[:, failed].ravel())
+                lower = numpy.concatenate((lower, split[:-1].ravel()))
+                upper = numpy.concatenate((upper, split[1:].ravel()))
+
+        positive = ~direct
+        result[positive] = _interpolate(numpy.log(q_all[positive]), nodes, values) if len(nodes) > 1 else values
+        model.adaptive_info = info
+        return self._get_array_result(out, result, _is_array(q))
+
+    def _get_inside(self, targets, lower, upper): # returns intervals which contain requested q-values (others don't need to be refined)
+        inside = numpy.searchsorted(targets, upper, 'left') > numpy.searchsorted(targets, lower, 'right')
+        return lower[inside], upper[inside]
+
+    def calculate_stream(self, model, qs, out, chunk_size=None): # calculates I(q) chunk by chunk (memory is bounded by chunk size); returns number of q-values
+        # "qs" is (q,), (qx, qy) or (qx, qy, qz) of sliceable arrays (e.g. numpy.memmap) or an iterator which yields such tuples as chunks.
+        # "out" is a path or file object to which I(q) is written as raw doubles or a writable buffer (e.g. numpy.memmap) which is filled.
+        if not model.id in self._created_models:
+            raise ValueError('model.id')
+
+        chunk_size  = chunk_size or self.chunk_size
+        cmodel      = self._created_models[model.id]
+        cparameters = self._get_model_cparameters(model) # packed once and used for all chunks
+
+        if _is_array(qs) or isinstance(qs, (array.array, ctypes.Array)):
+            qs = (qs,)
+        if isinstance(qs, (tuple, list)):
+            chunks = (tuple(q[start:start + chunk_size] for q in qs) for start in xrange(0, len(qs[0]), chunk_size))
+        else:
+            chunks = (chunk if isinstance(chunk, (tuple, list)) else (chunk,) for chunk in qs)
+
+        stream = None
+        buffered = _is_array(out) or isinstance(out, (array.array, ctypes.Array)) or not hasattr(out, 'write')
+        if isinstance(out, basestring):
+            stream = out = open(out, 'wb')
+            buffered = False
+        elif buffered:
+            out_ptr, out_owner = _as_output_data(out, len(out))
+            out_address = ctypes.cast(out_ptr, ctypes.c_void_p).value
+
+        size   = ctypes.sizeof(ctypes.c_double)
+        buffer = (ctypes.c_double * chunk_size)() # I(q) of a single chunk
+        count  = 0
+        try:
+            for chunk in chunks:
+                name = ('calculate_q', 'calculate_qxqy', 'calculate_qxqyqz')[len(chunk) - 1]
+                if getattr(self, '_' + name) is None:
+                    raise Exception()
+                n = len(chunk[0])
+                if n > len(buffer): # chunks of iterators may be larger
+                    buffer = (ctypes.c_double * n)()
+                iq = (ctypes.c_double * n).from_buffer(buffer)
+
+                started = timeit.default_timer() if self._stats is not None else None
+                if (name == 'calculate_qxqy') and self.isotropic and not model.model_info.orientation:
+                    self._calculate_isotropic(model, cmodel, cparameters, chunk[0], chunk[1], iq, started)
+                else:
+                    self._calculate_iq(name, model, cmodel, cparameters, chunk, iq, started, cached=False)
+
+                if buffered:
+                    if count + n > len(out):
+                        raise ValueError('out')
+                    ctypes.memmove(out_address + count * size, iq, n * size)
+                else:
+                    out.write(ctypes.string_at(iq, n * size))
+                count += n
+        finally:
+            if stream is not None:
+                stream.close()
+
+        if buffered and hasattr(out, 'flush'):
+            out.flush() # e.g. writes dirty pages of memory-mapped output
+        return count
+
+    def calculate_async(self, model, name, qs): # returns Future of I(q); concurrent identical requests are coalesced and small ones are batched
+        if not model.id in self._created_models:
+            raise ValueError('model.id')
+        with self._dispatcher_lock:
+            if self.dispatcher is None:
+                from PluginModelAsync import PluginModelDispatcher
+                self.dispatcher = PluginModelDispatcher(self)
+        return self.dispatcher.submit(model, name, qs)
+
+    def calculate_q_average(self, model, q, order=76, rtol=None, out=None): # averages I(qx, qy, qz) over directions of q with a single call per order
+        # if "rtol" is set then orders of ORIENTATION_ORDERS (starting at "order") are used until successive averages agree within "rtol"
+        if numpy is None:
+            raise Exception('calculate_q_average requires numpy')
+        if not model.id in self._created_models:
+            raise ValueError('model.id')
+        if not model.model_info.orientation: # average of isotropic model
+            model.average_info = {'order': 0, 'error': 0.0, 'points': 0}
+            return self.calculate_q(model, q, out)
+        if self._calculate_qxqyqz is None:
             raise Exception()
 
-        n = nx
-        iq_data = (ctypes.c_double * n)()
-        qx_data = (ctypes.c_double * n)(*qx)
-        qy_data = (ctypes.c_double * n)(*qy)
-        qz_data = (ctypes.c_double * n)(*qz)
-        self._calculate_qxqyqz(cmodel, cparameters, n, iq_data, qx_data, qy_data, qz_data)
-        return list(iq_data)
+        q_ptr, n, q_owner = _as_input_data(q)
+        q_all   = numpy.asarray(q_owner, dtype=numpy.float64)
+        orders  = [order] if rtol is None else [o for o in ORIENTATION_ORDERS if o >= order] or [order]
+        started = timeit.default_timer() if self._stats is not None else None
+        cmodel      = self._created_models[model.id]
+        cparameters = self._get_model_cparameters(model)
+
+        # q is split into chunks, so memory is bounded by chunk_size points per thread (instead of n * order^2 points)
+        result = None
+        info   = {'order': None, 'error': None, 'points': 0}
+        for current in orders:
+            weights = _get_orientation_nodes(current)[3]
+            m       = len(weights)
+            per     = max(self.chunk_size * max(self.threads, 1) // m, 1) # q-values per chunk
+            cached  = 3 * n * m * ctypes.sizeof(ctypes.c_double) <= _orientation_points.max_bytes
+            buffer  = numpy.empty(min(per, n) * m)
+            average = numpy.empty(n)
+            for start in xrange(0, n, per):
+                q_chunk = q_all[start:start + per]
+                points  = _get_orientation_points(current, q_chunk, cached)
+                iq      = self._calculate_iq('calculate_qxqyqz', model, cmodel, cparameters, points, buffer[:len(points[0])], started)
+                average[start:start + per] = iq.reshape(len(q_chunk), m).dot(weights)
+                started = timeit.default_timer() if self._stats is not None else None
+            info['points'] += n * m
+            info['order']   = current
+            if result is not None:
+                scale = numpy.maximum(numpy.abs(average), numpy.finfo(numpy.float64).tiny)
+                info['error'] = float((numpy.abs(average - result) / scale).max()) if n else 0.0
+                if info['error'] <= rtol:
+                    result = average
+                    break
+            result = average
+
+        model.average_info = info
+        return self._get_array_result(out, result, _is_array(q))
+
+    def calculate_q_batch(self, model, q, parameter_sets, out=None): # calculates I(q) for m parameter sets and returns an (m x nq) result
+        if not model.id in self._created_models:
+            raise ValueError('model.id')
+        if self._calculate_q is None:
+            raise Exception()
+
+        started = timeit.default_timer() if self._stats is not None else None
+        cmodel  = self._created_models[model.id]
+        names   = [p.name for p in model.model_info.parameters]
+
+        # parameter sets are either sequences of values (ordered like ModelInfo.parameters) or dictionaries which override model.parameters
+        parameters = PluginModelParameterCollection(dict((name, model.parameters[name]) for name in names))
+        block      = ParameterBlock(model.model_info)
+        block.cutoff = model.cutoff
+        block.mass   = model.mass
+        overridden = set()
+        def update(parameter_set):
+            if isinstance(parameter_set, dict):
+                for name in overridden.difference(parameter_set): # restore values overridden by previous parameter set
+                    parameters[name] = model.parameters[name]
+                overridden.clear()
+                overridden.update(parameter_set)
+                for name, value in parameter_set.iteritems():
+                    parameters[name] = value
+            else:
+                if len(parameter_set) != len(names):
+                    raise ValueError('parameter_sets')
+                for name, value in zip(names, parameter_set):
+                    parameters[name] = value
+            return block.update(parameters)
+
+        q_ptr, n, q_owner = _as_input_data(q)
+        m = len(parameter_sets)
+        if out is not None:
+            iq_ptr, iq_owner = _as_output_data(out, m * n)
+        elif _is_array(q) or _is_array(parameter_sets):
+            iq_owner = numpy.empty((m, n))
+            iq_ptr   = iq_owner.ctypes.data_as(c_double_p)
+        else:
+            iq_owner = iq_ptr = (ctypes.c_double * (m * n))()
+
+        if started is not None:
+            converted = timeit.default_timer()
+
+        if self._calculate_q_many is not None:
+            # every parameter set needs its own block which has to be alive during the call
+            cparameters     = [ctypes.create_string_buffer(update(parameter_set).raw) for parameter_set in parameter_sets]
+            cparameter_ptrs = (c_parameters_p * m)(*[ctypes.addressof(c) for c in cparameters])
+            if started is not None:
+                packed = timeit.default_timer()
+            with self._get_lock(model):
+                self._calculate_q_many(cmodel, m, cparameter_ptrs, n, iq_ptr, q_ptr)
+        else:
+            # the same block is patched for each parameter set (packing time is included in native time)
+            iq_address = ctypes.cast(iq_ptr, ctypes.c_void_p).value
+            row_size   = ctypes.sizeof(ctypes.c_double) * n
+            with self._get_lock(model):
+                for i, parameter_set in enumerate(parameter_sets):
+                    cparameters = update(parameter_set)
+                    self._calculate_q(cmodel, cparameters, n, ctypes.cast(iq_address + i * row_size, c_double_p), q_ptr)
+            if started is not None:
+                packed = converted
+
+        if started is not None:
+            self._record(model, 'calculate_q_batch', m * n, packed - converted, converted - started, timeit.default_timer() - packed)
+
+        if out is not None:
+            return out
+        if isinstance(iq_owner, ctypes.Array):
+            return [list(iq_owner[i * n:(i + 1) * n]) for i in xrange(m)]
+        return iq_owner
+
+    def _calculate_iq(self, name, model, cmodel, cparameters, qs, out, started=None, cached=True, entry=None, points=None, packed=None): # passes q-arrays and result buffer to external function "name" (without copying if possible)
+        # "entry" and "points" are recorded instead of "name" and the number of q-values (e.g. if calculate_qxqy is calculated by calculate_q)
+        if (started is not None) and (packed is None):
+            packed = timeit.default_timer()
+
+        q_data = [_as_input_data(q) for q in qs]
+        n      = q_data[0][1]
+        for q_ptr, nq, q_owner in q_data:
+            if nq != n:
+                raise Exception()
+
+        if out is not None:
+            iq_ptr, iq_owner = _as_output_data(out, n)
+        elif any(_is_array(q) for q in qs):
+            iq_owner = numpy.empty(n)
+            iq_ptr   = iq_owner.ctypes.data_as(c_double_p)
+        else:
+            iq_owner = iq_ptr = (ctypes.c_double * n)()
+
+        cache = self._get_cache(model) if cached else None
+        if cache is not None:
+            digest = hashlib.sha1()
+            for q_ptr, nq, q_owner in q_data:
+                digest.update(q_owner)
+            key    = (self._library, model.data, name, cparameters.raw, digest.digest())
+            result = cache.get(key)
+            if result is not None:
+                ctypes.memmove(iq_ptr, result, len(result))
+                if started is not None:
+                    self._record(model, entry or name, n if points is None else points, packed - started, timeit.default_timer() - packed, 0.0, True)
+                return self._get_iq_result(out, iq_owner)
+
+        if started is not None:
+            converted = timeit.default_timer()
+
+        q_ptrs = [q_ptr for q_ptr, nq, q_owner in q_data]
+        if self.backend is not None:
+            self.backend.calculate(name, cparameters, n, iq_ptr, q_ptrs, model.data)
+        else:
+            with self._get_lock(model):
+                function = getattr(self, '_' + name)
+                block, bound = self._pin_parameters(model, cmodel, cparameters, name == 'calculate_q')
+                try:
+                    if bound is not None: # parameters have already been parsed by external library
+                        calculate_q_bound, handle = self._calculate_q_bound, bound.handle
+                        function = lambda cmodel, cparameters, n, iq_ptr, q_ptr: calculate_q_bound(handle, n, iq_ptr, q_ptr)
+
+                    if (self.threads > 1) and (n > self.chunk_size) and model.model_info.reentrant:
+                        self._calculate_chunks(function, cmodel, cparameters, n, iq_ptr, q_ptrs)
+                    else:
+                        function(cmodel, cparameters, n, iq_ptr, *q_ptrs)
+                finally:
+                    self._unpin_parameters(block, cparameters, bound)
+
+        if started is not None:
+            self._record(model, entry or name, n if points is None else points, packed - started, converted - packed, timeit.default_timer() - converted)
+
+        if cache is not None:
+            result = ctypes.string_at(iq_ptr, n * ctypes.sizeof(ctypes.c_double))
+            cache.put(key, result, len(result) + len(key[3]))
+
+        return self._get_iq_result(out, iq_owner)
+
+    def _calculate_isotropic(self, model, cmodel, cparameters, qx, qy, out, started): # calls calculate_q once for unique |q| and scatters results to (qx, qy)
+        qx_ptr, nx, qx_owner = _as_input_data(qx)
+        qy_ptr, ny, qy_owner = _as_input_data(qy)
+        if nx != ny:
+            raise Exception()
+
+        # calculations are recorded as calculate_qxqy; finding unique |q| is recorded as conversion
+        packed    = timeit.default_timer() if started is not None else None
+        tolerance = self.isotropic_tolerance
+        if numpy is not None:
+            q = numpy.hypot(qx_owner, qy_owner)
+            if tolerance:
+                q = numpy.round(q / tolerance) * tolerance
+            unique, inverse = numpy.unique(q, return_inverse=True)
+            iq_unique = numpy.empty(len(unique))
+            self._calculate_iq('calculate_q', model, cmodel, cparameters, (unique,), iq_unique, started, entry='calculate_qxqy', points=nx, packed=packed)
+            return self._get_array_result(out, iq_unique[inverse], _is_array(qx) or _is_array(qy))
+
+        # without numpy
+        index   = {}
+        inverse = []
+        for x, y in zip(qx_owner, qy_owner):
+            q = (x * x + y * y) ** 0.5
+            if tolerance:
+                q = round(q / tolerance) * tolerance
+            inverse.append(index.setdefault(q, len(index)))
+        unique = [0.0] * len(index)
+        for q, i in index.iteritems():
+            unique[i] = q
+        iq_unique = self._calculate_iq('calculate_q', model, cmodel, cparameters, (unique,), None, started, entry='calculate_qxqy', points=nx, packed=packed)
+        iq        = [iq_unique[i] for i in inverse]
+        if out is not None:
+            iq_ptr, iq_owner = _as_output_data(out, nx)
+            iq_owner[:] = iq
+            return out
+        return iq
+
+    def _get_cache(self, model): # returns ResultCache which is used for model (models created with other data than strings aren't cached)
+        if (model.data is None) or isinstance(model.data, basestring):
+            return self.cache
+        return None
+
+    def _get_array_result(self, out, iq, as_array): # copies numpy result "iq" into "out" or returns it as array or list
+        if out is not None:
+            iq_ptr, iq_owner = _as_output_data(out, len(iq))
+            ctypes.memmove(iq_ptr, iq.ctypes.data, iq.nbytes)
+            return out
+        return iq if as_array else iq.tolist()
+
+    def _get_iq_result(self, out, iq_owner):
+        if out is not None:
+            return out
+        if isinstance(iq_owner, ctypes.Array):
+            return list(iq_owner)
+        return iq_owner
+
+    def _pin_parameters(self, model, cmodel, cparameters, bind=False): # marks parameter block of model (and its bound handle) as used by a calculation; returns (block, bound)
+        # while a calculation runs, its block isn't patched and its handle isn't released (see ParameterBlock.update and _unpin_parameters)
+        with self._lock:
+            block = model.parameter_block
+            if (block is None) or (cparameters is not block.buffer): # e.g. temporary blocks of calculate_q_batch or blocks which have been replaced
+                return None, None
+            block.calls += 1
+            bound = self._get_bound_parameters(model, cmodel, cparameters) if bind and (self._calculate_q_bound is not None) else None
+            if bound is not None:
+                bound.calls += 1
+            return block, bound
+
+    def _unpin_parameters(self, block, cparameters, bound):
+        if block is None:
+            return
+        with self._lock:
+            if cparameters is block.buffer:
+                block.calls -= 1
+            if bound is not None:
+                bound.calls -= 1
+                if bound.replaced and not bound.calls and (self._release_parameters is not None):
+                    self._release_parameters(bound.handle)
+
+    def _get_bound_parameters(self, model, cmodel, cparameters): # returns _BoundParameters of model's parameter block (it's rebound whenever the block changes)
+        bound = self._bound_parameters.get(model.id)
+        if (bound is not None) and (bound.buffer is cparameters) and (bound.version == model.parameter_block.version):
+            return bound
+
+        self._release_bound_parameters(model.id)
+        handle = self._bind_parameters(cmodel, cparameters)
+        if handle is None: # parameters are rejected by external library
+            return None
+        bound = self._bound_parameters[model.id] = _BoundParameters(cparameters, model.parameter_block.version, handle)
+        return bound
+
+    def _release_bound_parameters(self, id): # handles which are still used by running calculations are released by the last of them
+        bound = self._bound_parameters.pop(id, None)
+        if bound is not None:
+            bound.replaced = True
+            if not bound.calls:
+                self._release_parameters(bound.handle)
+
+    def _calculate_chunks(self, function, cmodel, cparameters, n, iq_ptr, q_ptrs): # splits calculation into chunks which are executed by a thread pool
+        if (self._pool is None) or (self._pool_size != self.threads):
+            if self._pool is not None:
+                self._pool.close()
+            self._pool      = multiprocessing.pool.ThreadPool(self.threads)
+            self._pool_size = self.threads
+
+        size      = ctypes.sizeof(ctypes.c_double)
+        addresses = [ctypes.cast(p, ctypes.c_void_p).value for p in [iq_ptr] + q_ptrs]
+        def calculate(start): # each chunk writes into its slice of the output buffer (ctypes releases the GIL during the call)
+            count = min(self.chunk_size, n - start)
+            ptrs  = [ctypes.cast(address + start * size, c_double_p) for address in addresses]
+            function(cmodel, cparameters, count, *ptrs)
+
+        self._pool.map(calculate, range(0, n, self.chunk_size))
 
     # other calculations
     def calculate_ER(self, model):
@@ -510,10 +1469,29 @@ class PluginModelFactory(object): # does the hard work
         if self._calculate_ER is None:
             raise Exception()
         
+        started     = timeit.default_timer() if self._stats is not None else None
         cmodel      = self._created_models[model.id]
-        cparameters = self._get_cparameters(model.model_info, model.parameters)
+        cparameters = self._get_model_cparameters(model)
+        if started is not None:
+            packed = timeit.default_timer()
         
-        return self._calculate_ER(cmodel, cparameters)
+        cache  = self._get_cache(model)
+        key    = (self._library, model.data, 'calculate_ER', cparameters.raw) if cache is not None else None
+        result = cache.get(key) if cache is not None else None
+        cached = result is not None
+        if not cached:
+            block, bound = self._pin_parameters(model, cmodel, cparameters)
+            try:
+                with self._get_lock(model):
+                    result = self._calculate_ER(cmodel, cparameters)
+            finally:
+                self._unpin_parameters(block, cparameters, bound)
+            if cache is not None:
+                cache.put(key, result, len(key[3]))
+
+        if started is not None:
+            self._record(model, 'calculate_ER', 1, packed - started, 0.0, timeit.default_timer() - packed, cached)
+        return result
         
     def calculate_VR(self, model):
         if not model.id in self._created_models:
@@ -521,10 +1499,77 @@ class PluginModelFactory(object): # does the hard work
         if self._calculate_VR is None:
             raise Exception()
         
+        started     = timeit.default_timer() if self._stats is not None else None
         cmodel      = self._created_models[model.id]
-        cparameters = self._get_cparameters(model.model_info, model.parameters)
+        cparameters = self._get_model_cparameters(model)
+        if started is not None:
+            packed = timeit.default_timer()
         
-        return self._calculate_VR(cmodel, cparameters)
+        cache  = self._get_cache(model)
+        key    = (self._library, model.data, 'calculate_VR', cparameters.raw) if cache is not None else None
+        result = cache.get(key) if cache is not None else None
+        cached = result is not None
+        if not cached:
+            block, bound = self._pin_parameters(model, cmodel, cparameters)
+            try:
+                with self._get_lock(model):
+                    result = self._calculate_VR(cmodel, cparameters)
+            finally:
+                self._unpin_parameters(block, cparameters, bound)
+            if cache is not None:
+                cache.put(key, result, len(key[3]))
+
+        if started is not None:
+            self._record(model, 'calculate_VR', 1, packed - started, 0.0, timeit.default_timer() - packed, cached)
+        return result
+
+    # statistics
+    def enable_stats(self, callback=None): # starts collecting call counts and timings; callback(model name, entry, points, pack, convert, native) is called after each calculation
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = {}
+            self._stats_callback = callback
+
+    def disable_stats(self):
+        with self._stats_lock:
+            self._stats          = None
+            self._stats_callback = None
+
+    def reset_stats(self):
+        with self._stats_lock:
+            if self._stats is not None:
+                self._stats = {}
+
+    def stats(self): # returns snapshot {model name: {entry: {calls, points, pack, convert, native, cached}}}; times are in seconds
+        snapshot = {}
+        with self._stats_lock:
+            for (model_name, entry), (calls, points, pack, convert, native, cached) in (self._stats or {}).iteritems():
+                snapshot.setdefault(model_name, {})[entry] = {
+                    'calls'   : calls,
+                    'points'  : points,
+                    'pack'    : pack,
+                    'convert' : convert,
+                    'native'  : native,
+                    'cached'  : cached}
+        return snapshot
+
+    def _record(self, model, entry, points, pack, convert, native, cached=False):
+        with self._stats_lock:
+            if self._stats is None:
+                return
+            key    = (model.model_info.name, entry)
+            record = self._stats.get(key)
+            if record is None:
+                record = self._stats[key] = [0, 0, 0.0, 0.0, 0.0, 0]
+            record[0] += 1
+            record[1] += points
+            record[2] += pack
+            record[3] += convert
+            record[4] += native
+            record[5] += cached
+            callback = self._stats_callback
+        if callback is not None:
+            callback(model.model_info.name, entry, points, pack, convert, native)
 
 
 #################################################################################
@@ -552,6 +1597,7 @@ def Test(path):
     print 'unfittable:  ', model_info.unfittable
     print 'integer:     ', model_info.integer
     print 'polydisperse:', model_info.polydisperse
+    print 'reentrant:   ', model_info.reentrant
     print
 
     # a concrete model can be created which holds the model information and default/modified parameter values
@@ -567,6 +1613,8 @@ def Test(path):
     print 'q     ', model.calculate_q(     [1, 2])
     print 'qxqy  ', model.calculate_qxqy(  [1, 2], [1, 2])
     print 'qxqyqz', model.calculate_qxqyqz([1, 2], [1, 2], [1, 2])
+    print 'batch ', model.calculate_q_batch([1, 2], [{'radius': 10.0}, {'radius': 20.0}])
+    print 'async ', model.calculate_q_async([1, 2]).result()
     print 'er    ', model.calculate_ER()
     print 'vr    ', model.calculate_VR()
     print
@@ -578,7 +1626,11 @@ def Test(path):
     print 'vr    ', model.calculate_VR()
     print
 
-    # when factory and model become out of scope, the model and library will be released 
+    # when factory and model become out of scope, the model and library will be released (asynchronous calculations don't keep them alive)
+    factory_ref = weakref.ref(factory)
+    del model, factory
+    print 'released', factory_ref() is None
+    print
 
 if __name__ == "__main__":
     print 'Main: Starting...'
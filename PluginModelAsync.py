@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import ctypes
+import timeit
+import weakref
+import hashlib
+import threading
+import collections
+
+from PluginModel import numpy, _as_input_data, _is_array
+
+#################################################################################
+## helpers
+
+class Future(object): # result of an asynchronous calculation (the subset of concurrent.futures.Future which is needed by callers)
+    # instance
+    def __init__(self):
+        self._event     = threading.Event()
+        self._lock      = threading.Lock()
+        self._result    = None
+        self._error     = None
+        self._callbacks = []
+
+    # access
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None): # blocks until result is available; raises exception of calculation
+        if not self._event.wait(timeout):
+            raise Exception('timeout')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception('timeout')
+        return self._error
+
+    def add_done_callback(self, callback): # "callback(future)" is called by the worker thread (or immediately if future is done)
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    # helper
+    def _set(self, result, error=None):
+        with self._lock:
+            self._result = result
+            self._error  = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                pass
+
+class _Request(object): # pending calculation of a single caller
+    __slots__ = ('model', 'cmodel', 'name', 'raw', 'q_owners', 'n', 'as_array', 'key', 'future')
+
+    def __init__(self, model, cmodel, name, raw, q_owners, n, as_array, key):
+        self.model    = model
+        self.cmodel   = cmodel
+        self.name     = name
+        self.raw      = raw      # packed parameters (copied when the request is submitted)
+        self.q_owners = q_owners # converted q-arrays
+        self.n        = n
+        self.as_array = as_array
+        self.key      = key      # requests with the same key are coalesced
+        self.future   = Future()
+
+
+#################################################################################
+## dispatcher
+
+class PluginModelDispatcher(object): # calculates requests of concurrent callers on a worker thread; identical requests are coalesced and small ones are batched
+    # instance
+    def __init__(self, factory, window=0.002, max_points=None):
+        self._factory   = weakref.ref(factory, self._release) # the worker thread mustn't keep the factory alive (it stops when the factory is released)
+        self.window     = window                            # seconds the worker waits for further small requests
+        self.max_points = max_points or factory.chunk_size  # requests with more q-values are calculated on their own
+        self.coalesced  = 0                                 # number of requests which have been answered by another request
+        self.batches    = 0                                 # number of native evaluations
+        self.requests   = 0                                 # number of submitted requests
+
+        self._condition = threading.Condition()
+        self._queue     = collections.deque() # requests which have to be calculated
+        self._inflight  = {}                  # key -> request (until its result is available)
+        self._closed    = False
+        self._thread    = threading.Thread(target=self._run, name='PluginModelDispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self): # waits until pending requests are calculated and stops the worker thread
+        self._release()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _release(self, ref=None): # stops the worker thread once pending requests are calculated (it's also called when the factory is released)
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    # properties
+    def _get_factory(self): # returns PluginModelFactory or None if it has been released
+        return self._factory()
+    factory = property(_get_factory)
+
+    # requests
+    def submit(self, model, name, qs): # returns Future of I(q); "name" is calculate_q, calculate_qxqy or calculate_qxqyqz
+        # coalesced requests share the same Future (and result, which is read-only); numpy q-arrays mustn't be modified until it's done
+        factory = self.factory
+        if not model.id in factory._created_models:
+            raise ValueError('model.id')
+        if getattr(factory, '_' + name) is None:
+            raise Exception()
+
+        # parameters are packed by the caller, so the model may be modified while the request is pending.
+        # the block is also patched by synchronous calculations, so it's copied while the factory's lock is held
+        with factory._lock:
+            raw = factory._get_model_cparameters(model).raw
+        q_data   = [_as_input_data(q) for q in qs]
+        n        = q_data[0][1]
+        for q_ptr, nq, q_owner in q_data:
+            if nq != n:
+                raise Exception()
+        q_owners = [q_owner for q_ptr, nq, q_owner in q_data]
+
+        digest = hashlib.sha1()
+        for q_owner in q_owners:
+            digest.update(q_owner)
+        key     = (model.id, name, raw, digest.digest())
+        request = _Request(model, factory._created_models[model.id], name, raw, q_owners, n, any(_is_array(q) for q in qs), key)
+
+        with self._condition:
+            if self._closed:
+                raise Exception('closed')
+            self.requests += 1
+            inflight = self._inflight.get(key)
+            if inflight is not None: # identical request is already pending or being calculated
+                self.coalesced += 1
+                return inflight.future
+            self._inflight[key] = request
+            self._queue.append(request)
+            self._condition.notify()
+        return request.future
+
+    # worker
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                small = self._queue[0].n <= self.max_points
+
+            # wait for further small requests which can be calculated together
+            if small and (self.window > 0.0):
+                deadline = timeit.default_timer() + self.window
+                with self._condition:
+                    while not self._closed:
+                        remaining = deadline - timeit.default_timer()
+                        if (remaining <= 0.0) or (sum(r.n for r in self._queue) > self.max_points):
+                            break
+                        self._condition.wait(remaining)
+
+            with self._condition:
+                requests = list(self._queue)
+                self._queue.clear()
+            self._dispatch(requests)
+            del requests # requests (and their models) mustn't be kept alive while the worker waits
+
+    def _dispatch(self, requests): # requests for the same model, function and parameters are concatenated
+        groups = collections.OrderedDict()
+        for request in requests:
+            group_key = request.key[:3] if request.n <= self.max_points else request.key
+            groups.setdefault(group_key, []).append(request)
+        for group in groups.itervalues():
+            self._calculate(group)
+
+    def _calculate(self, group): # evaluates all requests of "group" with a single native call
+        first   = group[0]
+        factory = self.factory
+        try:
+            if (factory is None) or not first.model.id in factory._created_models:
+                raise ValueError('model.id')
+            qs = [self._concatenate([request.q_owners[k] for request in group]) for k in xrange(len(first.q_owners))]
+            if numpy is not None:
+                qs = [numpy.asarray(q, dtype=numpy.float64) for q in qs] # ctypes arrays are wrapped without copying
+            iq = self._evaluate(factory, first, qs)
+            results = []
+            start   = 0
+            for request in group:
+                result = iq[start:start + request.n]
+                start += request.n
+                if numpy is not None:
+                    result.flags.writeable = False # result is shared by coalesced requests
+                    if not request.as_array:
+                        result = result.tolist()
+                results.append(result)
+            error = None
+        except Exception as e:
+            results = [None] * len(group)
+            error   = e
+
+        with self._condition:
+            self.batches += 1
+            for request in group:
+                del self._inflight[request.key]
+        for request, result in zip(group, results):
+            request.future._set(result, error)
+
+    def _evaluate(self, factory, request, qs): # returns I(q) as numpy array (or list without numpy)
+        model       = request.model
+        cparameters = ctypes.create_string_buffer(request.raw, len(request.raw))
+        started     = timeit.default_timer() if factory._stats is not None else None
+        if (request.name == 'calculate_qxqy') and factory.isotropic and not model.model_info.orientation:
+            return factory._calculate_isotropic(model, request.cmodel, cparameters, qs[0], qs[1], None, started)
+        return factory._calculate_iq(request.name, model, request.cmodel, cparameters, qs, None, started)
+
+    @staticmethod
+    def _concatenate(arrays):
+        if len(arrays) == 1:
+            return arrays[0]
+        if numpy is not None:
+            return numpy.concatenate(arrays)
+        return [value for values in arrays for value in values]
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+import os
+import mmap
+import ctypes
+import tempfile
+import multiprocessing
+
+from PluginModel import PluginModelFactory, c_double_p
+
+#################################################################################
+## helpers
+
+class SharedBuffer(object): # file-backed memory block which can be mapped by several processes (passed by path instead of pickling its content)
+
+    # shared memory should not be written to disk
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+    # instance
+    def __init__(self, size=None, path=None): # creates a new block of "size" bytes or opens existing block at "path"
+        self.owner = path is None
+        if self.owner:
+            fd, path = tempfile.mkstemp(prefix='PluginModel-', dir=SharedBuffer.directory)
+            os.ftruncate(fd, size)
+        else:
+            fd   = os.open(path, os.O_RDWR)
+            size = os.fstat(fd).st_size
+        try:
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.path    = path
+        self.size    = size
+        self.address = ctypes.addressof(ctypes.c_char.from_buffer(self._mmap))
+
+    def __del__(self):
+        self.close()
+
+    # access
+    def pointer(self, offset): # returns c-pointer to doubles starting at "offset" (in bytes)
+        return ctypes.cast(self.address + offset, c_double_p)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap   = None
+            self.address = None
+            if self.owner:
+                os.unlink(self.path)
+
+def _worker(path, connection): # loads the library in a separate process and calculates I(q) for slices of a shared buffer
+    factory = PluginModelFactory(path)
+    models  = {} # data of create_model -> model (one c-model per data which has been requested)
+    buffer  = None
+    cparameters_raw = None
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        name, raw, data, buffer_path, capacity, narrays, start, count = task
+        try:
+            model = models.get(data)
+            if model is None:
+                model = models[data] = factory.create_model(data)
+            cmodel = factory._created_models[model.id]
+            if (buffer is None) or (buffer.path != buffer_path):
+                if buffer is not None:
+                    buffer.close()
+                buffer = SharedBuffer(path=buffer_path)
+            if raw != cparameters_raw: # the parameter block is usually the same for all calls
+                cparameters_raw = raw
+                cparameters     = ctypes.create_string_buffer(raw, len(raw))
+
+            size = ctypes.sizeof(ctypes.c_double)
+            ptrs = [buffer.pointer((k * capacity + start) * size) for k in xrange(narrays)]
+            getattr(factory, '_' + name)(cmodel, cparameters, count, *ptrs)
+            connection.send(None)
+        except Exception as e:
+            connection.send(repr(e))
+
+    if buffer is not None:
+        buffer.close()
+    models.clear() # destroys c-models
+    factory.unload()
+
+
+#################################################################################
+## execution backend
+
+class PluginModelProcessPool(object): # calculates I(q) in several processes which have loaded the same library; can be assigned to PluginModelFactory.backend
+    # instance
+    def __init__(self, path, processes=None, min_chunk_size=4096):
+        self.path           = path
+        self.processes      = processes or multiprocessing.cpu_count()
+        self.min_chunk_size = min_chunk_size # calculations with less q-values are not split
+
+        self._buffer   = None # shared buffer which holds I(q) and q-arrays
+        self._capacity = 0    # number of doubles per array within shared buffer
+        self._workers  = []   # (process, connection)
+        for i in xrange(self.processes):
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(path, child_connection))
+            process.daemon = True
+            process.start()
+            self._workers.append((process, connection))
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        for process, connection in self._workers:
+            try:
+                connection.send(None)
+            except (IOError, EOFError):
+                pass
+        for process, connection in self._workers:
+            process.join()
+            connection.close()
+        self._workers = []
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    # calculations
+    def calculate(self, name, cparameters, n, iq_ptr, q_ptrs, data=None): # only the packed parameter block and data of create_model are sent to the workers
+        # workers create their own c-model for "data", so only data which means the same in another process is accepted
+        if not ((data is None) or isinstance(data, basestring)):
+            raise ValueError('data of models calculated by PluginModelProcessPool must be None or a string')
+        if n == 0:
+            return
+        narrays = 1 + len(q_ptrs)
+        size    = ctypes.sizeof(ctypes.c_double)
+        if n > self._capacity:
+            if self._buffer is not None:
+                self._buffer.close()
+            self._buffer   = SharedBuffer(4 * n * size) # I(q), qx, qy and qz
+            self._capacity = n
+        capacity = self._capacity
+
+        # copy q-arrays into shared buffer
+        for k, q_ptr in enumerate(q_ptrs):
+            ctypes.memmove(self._buffer.address + (k + 1) * capacity * size, q_ptr, n * size)
+
+        # distribute slices to workers
+        chunk_size = max(self.min_chunk_size, -(-n // len(self._workers)))
+        raw        = cparameters.raw
+        busy       = []
+        for (process, connection), start in zip(self._workers, xrange(0, n, chunk_size)):
+            connection.send((name, raw, data, self._buffer.path, capacity, narrays, start, min(chunk_size, n - start)))
+            busy.append(connection)
+        errors = [error for error in (connection.recv() for connection in busy) if error is not None]
+
+        # copy I(q) out of shared buffer
+        ctypes.memmove(iq_ptr, self._buffer.address, n * size)
+        if errors:
+            raise Exception(errors[0])
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import ctypes
+import argparse
+import threading
+import multiprocessing
+import multiprocessing.connection
+
+from PluginModel import PluginModelFactory, PolydisperseParameter, numpy, _as_input_data, _as_output_data, _is_array, _create_default_parameters
+from PluginModelPool import SharedBuffer
+
+# number of arrays (I(q) and q-arrays) which are passed through shared memory
+ARRAYS = {
+    'calculate_q'      : 2,
+    'calculate_qxqy'   : 3,
+    'calculate_qxqyqz' : 4}
+
+# commands which are accepted from clients
+COMMANDS = frozenset(['get_model_info', 'create_model', 'destroy_model', 'calculate', 'calculate_ER', 'calculate_VR'])
+
+#################################################################################
+## server
+
+class PluginModelServer(object): # keeps loaded libraries of several clients; listens on a unix socket
+    # instance
+    def __init__(self, address, paths=(), max_calculations=None, threads=1):
+        self.address = address
+        self.threads = threads # PluginModelFactory.threads of loaded libraries
+        self.factories = {}    # path -> PluginModelFactory (every library is loaded once and shared by all clients)
+        self._lock     = threading.Lock()
+        self._calculations = threading.Semaphore(max_calculations or multiprocessing.cpu_count()) # caps concurrent calculations of all clients
+        self._listener = None
+        self._closed   = False
+        for path in paths: # preloaded libraries
+            self.get_factory(path)
+
+    def get_factory(self, path): # returns factory which has loaded library at "path" (it's loaded on first request)
+        path = os.path.realpath(path)
+        with self._lock:
+            factory = self.factories.get(path)
+            if factory is None:
+                factory = PluginModelFactory(path)
+                factory.threads = self.threads
+                self.factories[path] = factory
+            return factory
+
+    def serve_forever(self): # accepts clients until close is called; every client is handled by its own thread
+        self._listener = multiprocessing.connection.Listener(self.address, family='AF_UNIX')
+        try:
+            while not self._closed:
+                connection = self._listener.accept()
+                if self._closed:
+                    connection.close()
+                    break
+                thread = threading.Thread(target=self._handle, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self._listener.close()
+            self._listener = None
+
+    def close(self): # stops serve_forever (which is waiting for the next client)
+        self._closed = True
+        try:
+            multiprocessing.connection.Client(self.address, family='AF_UNIX').close()
+        except Exception:
+            pass
+
+    # requests
+    def _handle(self, connection): # messages are (command, arguments...); replies are (error, result)
+        models = {} # id -> (path, PluginModel) created for this client
+        state  = {'buffer': None}
+        try:
+            while True:
+                try:
+                    message = connection.recv()
+                except (EOFError, IOError):
+                    break
+                try:
+                    if not message[0] in COMMANDS:
+                        raise ValueError(message[0])
+                    result = getattr(self, '_' + message[0])(models, state, *message[1:])
+                    connection.send((None, result))
+                except Exception as e:
+                    connection.send((repr(e), None))
+        finally:
+            with self._lock:
+                for path, model in models.itervalues():
+                    model.destroy()
+            if state['buffer'] is not None:
+                state['buffer'].close()
+            connection.close()
+
+    def _get_model_info(self, models, state, path):
+        return self.get_factory(path).get_model_info()
+
+    def _create_model(self, models, state, path, data=None):
+        factory = self.get_factory(path)
+        with self._lock: # factories are shared by all clients (e.g. model ids are assigned by them)
+            model = factory.create_model(data)
+        models[model.id] = (os.path.realpath(path), model)
+        return model.id
+
+    def _destroy_model(self, models, state, id):
+        path, model = models.pop(id)
+        with self._lock:
+            model.destroy()
+
+    def _calculate(self, models, state, id, name, values, cutoff, mass, n, buffer_path, capacity, rtol=None): # I(q) and q-arrays are held by shared buffer of client
+        path, model = models[id]
+        factory = model.factory
+        buffer  = state['buffer']
+        if (buffer is None) or (buffer.path != buffer_path):
+            if buffer is not None:
+                buffer.close()
+            buffer = state['buffer'] = SharedBuffer(path=buffer_path)
+
+        # external functions mustn't access memory beyond the shared buffer
+        size = ctypes.sizeof(ctypes.c_double)
+        if not name in ARRAYS:
+            raise ValueError(name)
+        if not (isinstance(n, (int, long)) and isinstance(capacity, (int, long))):
+            raise ValueError('n')
+        if not 0 <= capacity * ARRAYS[name] * size <= buffer.size:
+            raise ValueError('capacity')
+        if not 0 <= n <= capacity:
+            raise ValueError('n')
+        if (rtol is not None) and (name != 'calculate_q'):
+            raise ValueError('rtol')
+
+        # calculations are done by the factory (e.g. isotropic models calculate I(qx, qy) as I(|q|)); it also serializes models which aren't reentrant
+        self._set_values(model, values, cutoff, mass)
+        arrays = [(ctypes.c_double * n).from_address(buffer.address + k * capacity * size) for k in xrange(ARRAYS[name])]
+        with self._calculations:
+            if rtol is not None:
+                factory.calculate_q_adaptive(model, arrays[1], float(rtol), arrays[0])
+            else:
+                getattr(factory, name)(model, *(arrays[1:] + [arrays[0]]))
+        return model.get_dropped_mass(), model.get_adaptive_info()
+
+    def _calculate_ER(self, models, state, id, values, cutoff, mass):
+        path, model = models[id]
+        self._set_values(model, values, cutoff, mass)
+        with self._calculations:
+            return model.factory.calculate_ER(model)
+
+    def _calculate_VR(self, models, state, id, values, cutoff, mass):
+        path, model = models[id]
+        self._set_values(model, values, cutoff, mass)
+        with self._calculations:
+            return model.factory.calculate_VR(model)
+
+    def _set_values(self, model, values, cutoff, mass): # assigns parameter values of a client (see RemoteModel._get_values); they are packed by the model's factory
+        def optional(value):
+            return None if value is None else float(value)
+        model.cutoff = float(cutoff)
+        model.mass   = float(mass)
+        for name, value in values.iteritems():
+            if (name in model.model_info.polydisperse) and isinstance(value, tuple):
+                points, weights, point_cutoff, point_mass = value
+                value = PolydisperseParameter([float(v) for v in points], [float(w) for w in weights], optional(point_cutoff), optional(point_mass))
+            else:
+                value = float(value)
+            model.parameters[name] = value
+
+
+#################################################################################
+## client
+
+class PluginModelClient(object): # connection to PluginModelServer; models are created by the server and calculated in its process
+    # instance
+    def __init__(self, address):
+        self._connection  = multiprocessing.connection.Client(address, family='AF_UNIX')
+        self._lock        = threading.Lock() # connection and shared buffer are used by all models of this client
+        self._buffer      = None
+        self._capacity    = 0
+        self._model_infos = {} # path -> ModelInfo
+
+    def __del__(self):
+        self.close()
+
+    def close(self): # models which haven't been destroyed are released by the server
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if self._buffer is not None:
+            self._buffer.close()
+            self._buffer = None
+
+    # models
+    def get_model_info(self, path):
+        model_info = self._model_infos.get(path)
+        if model_info is None:
+            model_info = self._model_infos[path] = self._call('get_model_info', path)
+        return model_info
+
+    def create_model(self, path, data=None): # returns RemoteModel which supports the calculations of PluginModel (see RemoteModel)
+        model_info = self.get_model_info(path)
+        return RemoteModel(self, self._call('create_model', path, data), model_info, _create_default_parameters(model_info))
+
+    def destroy_model(self, model):
+        if self._connection is not None:
+            self._call('destroy_model', model.id)
+        model.id     = None
+        model.client = None
+
+    # calculations
+    def calculate(self, model, name, qs, out=None, rtol=None):
+        with self._lock:
+            q_data = [_as_input_data(q) for q in qs]
+            n      = q_data[0][1]
+            for q_ptr, nq, q_owner in q_data:
+                if nq != n:
+                    raise Exception()
+
+            size = ctypes.sizeof(ctypes.c_double)
+            if (self._buffer is None) or (n > self._capacity):
+                if self._buffer is not None:
+                    self._buffer.close()
+                self._capacity = max(n, 1)
+                self._buffer   = SharedBuffer(4 * self._capacity * size) # I(q), qx, qy and qz
+            capacity = self._capacity
+            for k, (q_ptr, nq, q_owner) in enumerate(q_data):
+                ctypes.memmove(self._buffer.address + (k + 1) * capacity * size, q_ptr, n * size)
+
+            model.dropped, model.adaptive_info = self._call_locked(
+                'calculate', model.id, name, model._get_values(), model.cutoff, model.mass, n, self._buffer.path, capacity, rtol)
+
+            if out is not None:
+                iq_ptr, iq_owner = _as_output_data(out, n)
+                ctypes.memmove(iq_ptr, self._buffer.address, n * size)
+                return out
+            if any(_is_array(q) for q in qs):
+                iq = numpy.empty(n)
+                ctypes.memmove(iq.ctypes.data, self._buffer.address, n * size)
+                return iq
+            return self._buffer.pointer(0)[:n]
+
+    def calculate_value(self, model, name):
+        return self._call(name, model.id, model._get_values(), model.cutoff, model.mass)
+
+    # helper
+    def _call(self, *message):
+        with self._lock:
+            return self._call_locked(*message)
+
+    def _call_locked(self, *message):
+        if self._connection is None:
+            raise Exception('closed')
+        self._connection.send(message)
+        error, result = self._connection.recv()
+        if error is not None:
+            raise Exception(error)
+        return result
+
+class RemoteModel(object): # model which is calculated by the server; it supports the calculations of PluginModel which are defined below
+    # parameter values are sent with every calculation and packed by the server (calculate_q_batch, calculate_q_average,
+    # calculate_stream and calculate_*_async aren't supported)
+
+    # instance
+    def __init__(self, client, id, model_info, parameters):
+        self.client     = client
+        self.id         = id
+        self.model_info = model_info
+        self.parameters = parameters
+        self.cutoff     = 0.0
+        self.mass       = 1.0
+        self.dropped       = {}   # fraction of weight which has been dropped from each polydisperse parameter by last calculation
+        self.adaptive_info = None # error estimate and number of evaluations of last adaptive calculation
+
+    def __del__(self):
+        if self.client is not None:
+            try:
+                self.destroy()
+            except Exception:
+                pass
+
+    # model information
+    def get_model_info(self):
+        return self.model_info
+
+    def get_dropped_mass(self):
+        return dict(self.dropped)
+
+    def get_adaptive_info(self):
+        return dict(self.adaptive_info) if self.adaptive_info else {}
+
+    # model instantiation
+    def destroy(self):
+        self.client.destroy_model(self)
+
+    # calculations
+    def calculate_q(self, q, out=None, rtol=None): # if "rtol" is set then I(q) is interpolated from an adaptively refined grid
+        return self.client.calculate(self, 'calculate_q', (q,), out, rtol)
+
+    def calculate_qxqy(self, qx, qy, out=None):
+        return self.client.calculate(self, 'calculate_qxqy', (qx, qy), out)
+
+    def calculate_qxqyqz(self, qx, qy, qz, out=None):
+        return self.client.calculate(self, 'calculate_qxqyqz', (qx, qy, qz), out)
+
+    def calculate_ER(self):
+        return self.client.calculate_value(self, 'calculate_ER')
+
+    def calculate_VR(self):
+        return self.client.calculate_value(self, 'calculate_VR')
+
+    # helper
+    def _get_values(self): # name -> value or (values, weights, cutoff, mass) of polydisperse parameter
+        values = {}
+        for name in self.parameters:
+            value = self.parameters[name]
+            if isinstance(value, PolydisperseParameter):
+                value = (value.values, value.weights, value.cutoff, value.mass)
+            values[name] = value
+        return values
+
+
+#################################################################################
+## main
+
+def main():
+    parser = argparse.ArgumentParser(description='keeps plugin libraries loaded and calculates models of PluginModelClient connections')
+    parser.add_argument('address'           , help='path of unix socket')
+    parser.add_argument('libraries'         , nargs='*', help='libraries which are loaded on start')
+    parser.add_argument('--max-calculations', type=int, help='number of concurrent calculations of all clients (default: number of cpus)')
+    parser.add_argument('--threads'         , type=int, default=1, help='threads used by a single calculation of reentrant models')
+    args = parser.parse_args()
+
+    server = PluginModelServer(args.address, args.libraries, args.max_calculations, args.threads)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
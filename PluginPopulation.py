@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+
+import ctypes
+import timeit
+
+from PluginModel import numpy, ParameterType, PolydisperseParameter, c_double_p, c_parameters_p, _as_input_data, _as_output_data
+
+# numpy type of size_t fields of parameter blocks
+_size_t_dtype = numpy.uint32 if ctypes.sizeof(ctypes.c_size_t) == 4 else numpy.uint64
+
+#################################################################################
+## helpers
+
+def _get_block_dtype(model_info, layout): # packed structured type of a parameter block (same layout as ParameterBlock; "layout" holds the number of points of each polydisperse parameter)
+    npoints = dict(zip(model_info.polydisperse, layout))
+    fields  = []
+    for i, p in enumerate(model_info.parameters):
+        if not p.name in npoints:
+            fields += [('t%i' % i, _size_t_dtype), ('v%i' % i, numpy.float64)]
+        else:
+            fields += [('t%i' % i, _size_t_dtype), ('n%i' % i, _size_t_dtype),
+                       ('v%i' % i, numpy.float64, (npoints[p.name],)), ('w%i' % i, numpy.float64, (npoints[p.name],))]
+    fields += [('end', _size_t_dtype)]
+
+    count  = len(model_info.parameters) + 1 # parameters and end
+    data   = numpy.dtype(fields)
+    header = [('count', _size_t_dtype), ('offsets', _size_t_dtype, (count,))]
+    # offsets are relative to the end of the header
+    offsets = [data.fields['t%i' % i][1] for i in xrange(len(model_info.parameters))] + [data.fields['end'][1]]
+    return numpy.dtype(header + [('data', data)]), offsets
+
+
+#################################################################################
+## population
+
+class PluginModelPopulation(object): # parameter sets of many models in a numpy structured array; rows are calculated by a single c-model of "factory"
+    # instance
+    def __init__(self, factory, size, data=None):
+        model_info = factory.get_model_info()
+        self.factory    = factory
+        self.model_info = model_info
+        self.model      = factory.create_model(data) # provides c-model (its own parameters aren't used)
+
+        # one column per parameter; polydisperse parameters are packed as a single point at the column value unless points are assigned
+        self._values = numpy.empty(size, dtype=[(p.name, numpy.float64) for p in model_info.parameters])
+        for p in model_info.parameters:
+            self._values[p.name] = p.default
+
+        # ragged points of polydisperse parameters: rows refer to counts[row] values and weights starting at starts[row]
+        self._counts  = dict((name, numpy.zeros(size, dtype=numpy.intp)) for name in model_info.polydisperse)
+        self._starts  = dict((name, numpy.zeros(size, dtype=numpy.intp)) for name in model_info.polydisperse)
+        self._points  = dict((name, numpy.empty(0)) for name in model_info.polydisperse)
+        self._weights = dict((name, numpy.empty(0)) for name in model_info.polydisperse)
+
+        # packed blocks (built on demand): rows with equal layout share a structured array
+        self._blocks = None # list of structured arrays
+        self._group  = None # row -> index of structured array
+        self._index  = None # row -> index within structured array
+
+    def __len__(self):
+        return len(self._values)
+
+    def close(self):
+        if self.model is not None:
+            self.model.destroy()
+            self.model = None
+
+    # parameter values
+    def __getitem__(self, name): # returns column of parameter "name" (read-only; use assignment to modify it)
+        column = self._values[name]
+        column.flags.writeable = False
+        return column
+
+    def __setitem__(self, name, values): # assigns a scalar or an array to a whole column
+        self.set_values(name, values)
+
+    def set_values(self, name, values, rows=None):
+        if not name in self.model_info.index:
+            raise ValueError(name)
+        self._values[name][self._get_rows(rows)] = values
+        self._blocks = None
+
+    def set_points(self, name, values, weights=None, rows=None): # assigns points of polydisperse parameter "name"; values and weights are shared (1d) or given per row (2d)
+        if not name in self._counts:
+            raise ValueError(name)
+        rows    = self._get_rows(rows)
+        values  = numpy.asarray(values, dtype=numpy.float64)
+        npoints = values.shape[-1]
+        values  = numpy.broadcast_to(values, (len(rows), npoints))
+        if weights is None:
+            weights = numpy.full(npoints, 1.0 / npoints)
+        weights = numpy.broadcast_to(numpy.asarray(weights, dtype=numpy.float64), (len(rows), npoints))
+
+        # new points are appended; side arrays are compacted once they are mostly unused
+        start = len(self._points[name])
+        self._points [name] = numpy.concatenate((self._points [name], values .ravel()))
+        self._weights[name] = numpy.concatenate((self._weights[name], weights.ravel()))
+        self._starts [name][rows] = start + npoints * numpy.arange(len(rows))
+        self._counts [name][rows] = npoints
+        if len(self._points[name]) > 2 * self._counts[name].sum():
+            self._compact(name)
+        self._blocks = None
+
+    def clear_points(self, name, rows=None): # rows use the column value of "name" again
+        if not name in self._counts:
+            raise ValueError(name)
+        self._counts[name][self._get_rows(rows)] = 0
+        self._blocks = None
+
+    def get_parameters(self, row): # returns {name: value} of "row" (polydisperse parameters with points are PolydisperseParameter)
+        parameters = {}
+        for p in self.model_info.parameters:
+            count = self._counts[p.name][row] if p.name in self._counts else 0
+            if count == 0:
+                parameters[p.name] = float(self._values[p.name][row])
+            else:
+                start = self._starts[p.name][row]
+                parameters[p.name] = PolydisperseParameter(
+                    self._points [p.name][start:start + count].copy(),
+                    self._weights[p.name][start:start + count].copy())
+        return parameters
+
+    # packed parameters
+    def get_block(self, row): # returns packed parameters of "row" (as expected by c-model)
+        self._pack()
+        block = self._blocks[self._group[row]]
+        index = self._index[row]
+        raw   = block[index:index + 1].tobytes()
+        return ctypes.create_string_buffer(raw, len(raw))
+
+    def _pack(self): # builds packed blocks of all rows (one structured array per layout)
+        if self._blocks is not None:
+            return
+        model_info = self.model_info
+        size       = len(self._values)
+        if model_info.polydisperse:
+            counts = numpy.column_stack([self._counts[name] for name in model_info.polydisperse])
+            layouts, group = numpy.unique(numpy.maximum(counts, 1), axis=0, return_inverse=True)
+        else:
+            layouts, group = numpy.ones((1, 0), dtype=numpy.intp), numpy.zeros(size, dtype=numpy.intp)
+        group = group.ravel()
+
+        blocks = []
+        index  = numpy.empty(size, dtype=numpy.intp)
+        for g, layout in enumerate(layouts):
+            rows  = numpy.flatnonzero(group == g)
+            index[rows] = numpy.arange(len(rows))
+            dtype, offsets = _get_block_dtype(model_info, tuple(layout))
+            block = numpy.zeros(len(rows), dtype=dtype)
+            block['count']   = len(offsets)
+            block['offsets'] = offsets
+            data = block['data']
+            for i, p in enumerate(model_info.parameters):
+                if not p.name in self._counts:
+                    data['t%i' % i] = ParameterType.Simple
+                    data['v%i' % i] = self._values[p.name][rows]
+                    continue
+                data['t%i' % i] = ParameterType.Polydisperse
+                counts = self._counts[p.name][rows]
+                npoints = max(counts.max(), 1)
+                data['n%i' % i] = npoints
+                empty   = counts == 0 # single point at column value
+                points  = self._starts[p.name][rows][:, None] + numpy.arange(npoints)[None, :]
+                points[empty] = 0
+                if len(self._points[p.name]): # points are gathered from side arrays
+                    data['v%i' % i] = self._points [p.name][points]
+                    data['w%i' % i] = self._weights[p.name][points]
+                data['v%i' % i][empty, 0] = self._values[p.name][rows][empty]
+                data['w%i' % i][empty, 0] = 1.0
+            data['end'] = ParameterType.End
+            blocks.append(block)
+
+        self._blocks = blocks
+        self._group  = group
+        self._index  = index
+
+    # calculations
+    def calculate_q(self, q, rows=None, out=None): # calculates I(q) of "rows" and returns an (m x nq) result
+        factory = self.factory
+        if (self.model is None) or not self.model.id in factory._created_models:
+            raise ValueError('model.id')
+        if factory._calculate_q is None:
+            raise Exception()
+
+        started = timeit.default_timer() if factory._stats is not None else None
+        rows    = self._get_rows(rows)
+        m       = len(rows)
+        q_ptr, n, q_owner = _as_input_data(q)
+        if out is not None:
+            iq_ptr, iq_owner = _as_output_data(out, m * n)
+        else:
+            iq_owner = numpy.empty((m, n))
+            iq_ptr   = iq_owner.ctypes.data_as(c_double_p)
+
+        # blocks are passed without copying
+        self._pack()
+        addresses = [block.ctypes.data for block in self._blocks]
+        itemsizes = [block.dtype.itemsize for block in self._blocks]
+        pointers  = [addresses[g] + i * itemsizes[g] for g, i in zip(self._group[rows], self._index[rows])]
+        if started is not None:
+            packed = timeit.default_timer()
+
+        cmodel = factory._created_models[self.model.id]
+        with factory._get_lock(self.model):
+            if factory._calculate_q_many is not None:
+                factory._calculate_q_many(cmodel, m, (c_parameters_p * m)(*pointers), n, iq_ptr, q_ptr)
+            else:
+                iq_address = ctypes.cast(iq_ptr, ctypes.c_void_p).value
+                row_size   = ctypes.sizeof(ctypes.c_double) * n
+                for i, pointer in enumerate(pointers):
+                    factory._calculate_q(cmodel, pointer, n, ctypes.cast(iq_address + i * row_size, c_double_p), q_ptr)
+
+        if started is not None:
+            factory._record(self.model, 'calculate_q_batch', m * n, packed - started, 0.0, timeit.default_timer() - packed)
+        return out if out is not None else iq_owner
+
+    def iterate_q(self, q, rows=None, batch_size=None): # yields (row, I(q)) of "rows"; rows are calculated in batches (I(q) is only valid until the next row of another batch)
+        rows = self._get_rows(rows)
+        q    = numpy.ascontiguousarray(q, dtype=numpy.float64) # converted once for all batches
+        if batch_size is None:
+            batch_size = max(self.factory.chunk_size // max(len(q), 1), 1)
+        buffer = numpy.empty((min(batch_size, len(rows)), len(q)))
+        for start in xrange(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            iq    = self.calculate_q(q, batch, buffer[:len(batch)])
+            for row, values in zip(batch, iq):
+                yield row, values
+
+    # helper
+    def _get_rows(self, rows): # row indices of None (all rows), a slice, a boolean mask or indices
+        if rows is None:
+            return numpy.arange(len(self._values))
+        return numpy.arange(len(self._values))[rows].ravel()
+
+    def _compact(self, name): # drops points which aren't referred to by any row
+        counts = self._counts[name]
+        starts = numpy.zeros(len(counts), dtype=numpy.intp)
+        starts[1:] = numpy.cumsum(counts)[:-1]
+        points = numpy.repeat(self._starts[name] - starts, counts) + numpy.arange(counts.sum())
+        self._points [name] = self._points [name][points]
+        self._weights[name] = self._weights[name][points]
+        self._starts [name] = starts
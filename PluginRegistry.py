@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+
+from PluginModel import PluginModelFactory, ModelInfo, ParameterInfo
+
+# file extensions of plugin libraries
+EXTENSIONS = ('.so', '.dll', '.dylib')
+
+INDEX_VERSION = 1 # is incremented if the format of index files changes
+
+#################################################################################
+## helpers
+
+def _get_digest(path): # sha1 of file content
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _encode_model_info(model_info): # ModelInfo as json-compatible dict
+    return {
+        'name'        : model_info.name,
+        'description' : model_info.description,
+        'flags'       : model_info.flags,
+        'parameters'  : [[p.name, p.description, p.unit, p.default, p.dispmin, p.dispmax, p.flags] for p in model_info.parameters]}
+
+def _str(text): # json returns unicode; ModelInfo decoded by PluginModelFactory holds str
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+def _decode_model_info(data):
+    return ModelInfo(
+        _str(data['name']),
+        _str(data['description']),
+        [ParameterInfo(_str(name), _str(description), _str(unit), default, dispmin, dispmax, flags)
+            for name, description, unit, default, dispmin, dispmax, flags in data['parameters']],
+        data['flags'])
+
+
+#################################################################################
+## registry
+
+class PluginRegistry(object): # knows the models of all libraries in "directories" without loading them; libraries are loaded when a model is created
+    # instance
+    def __init__(self, directories, index_path=None, idle_timeout=300.0):
+        self.directories  = list(directories)
+        self.index_path   = index_path   # json file which holds model information of scanned libraries (optional)
+        self.idle_timeout = idle_timeout # seconds after which libraries without models are unloaded (None keeps them loaded)
+
+        self._lock        = threading.RLock()
+        self._entries     = {}   # path -> index entry (mtime, size, sha1 and model information)
+        self._model_infos = {}   # path -> decoded ModelInfo
+        self._names       = {}   # model name -> path (first library wins if names are equal)
+        self._factories   = {}   # path -> PluginModelFactory of loaded library
+        self._used        = {}   # path -> time of last model creation
+        self._timer       = None # thread which unloads idle libraries
+        self._stopped     = threading.Event()
+        atexit.register(self._stopped.set) # idle timer mustn't run during interpreter shutdown
+
+        self._read_index()
+        self.scan()
+
+    def close(self): # stops idle timer and unloads all libraries
+        self._stopped.set()
+        with self._lock:
+            for factory in self._factories.itervalues():
+                factory.unload()
+            self._factories = {}
+            self._used      = {}
+
+    # index
+    def scan(self): # updates index; only libraries whose mtime or size changed are hashed and only new content is loaded
+        with self._lock:
+            entries = {}
+            paths   = [] # in order of directories
+            changed = False
+            for directory in self.directories:
+                for root, dirs, files in os.walk(directory):
+                    dirs.sort()
+                    for filename in sorted(files):
+                        if not filename.endswith(EXTENSIONS):
+                            continue
+                        path  = os.path.realpath(os.path.join(root, filename))
+                        entry = self._get_entry(path, self._entries.get(path))
+                        if (entry is None) or (path in entries):
+                            continue
+                        changed = changed or (entry is not self._entries.get(path))
+                        entries[path] = entry
+                        paths.append(path)
+
+            changed = changed or (len(entries) != len(self._entries))
+            self._entries     = entries
+            self._model_infos = {}
+            self._names       = {}
+            for path in paths:
+                entry = entries[path]
+                if entry['model_info'] is None: # isn't a plugin library
+                    continue
+                model_info = self._model_infos[path] = _decode_model_info(entry['model_info'])
+                self._names.setdefault(model_info.name, path)
+            if changed:
+                self._write_index()
+
+    def _get_entry(self, path, entry): # returns cached entry if library hasn't changed
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if (entry is not None) and (entry['mtime'] == stat.st_mtime) and (entry['size'] == stat.st_size):
+            return entry
+
+        sha1 = _get_digest(path)
+        if (entry is not None) and (entry['sha1'] == sha1): # e.g. touched or copied
+            entry = dict(entry, mtime=stat.st_mtime)
+            return entry
+
+        try:
+            factory = PluginModelFactory(path)
+            try:
+                model_info = _encode_model_info(factory.get_model_info())
+            finally:
+                factory.unload()
+        except Exception: # library doesn't export get_model_info (entry is kept to avoid loading it again)
+            model_info = None
+        return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1, 'model_info': model_info}
+
+    def _read_index(self):
+        if (self.index_path is None) or not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except ValueError: # index is rebuilt
+            return
+        if index.get('version') == INDEX_VERSION:
+            self._entries = index['libraries']
+
+    def _write_index(self):
+        if self.index_path is None:
+            return
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'libraries': self._entries}, f, indent=1, sort_keys=True)
+        os.rename(temp_path, self.index_path) # readers never see a partially written index
+
+    # model information (without loading libraries)
+    def get_model_names(self):
+        with self._lock:
+            return sorted(self._names)
+
+    def get_model_info(self, name):
+        with self._lock:
+            return self._model_infos[self._get_path(name)]
+
+    def get_path(self, name):
+        with self._lock:
+            return self._get_path(name)
+
+    def find(self, text): # returns names of models whose name, description or parameter names contain "text" (case insensitive)
+        text = text.lower()
+        with self._lock:
+            return sorted(name for name, path in self._names.iteritems() if self._matches(self._model_infos[path], text))
+
+    @staticmethod
+    def _matches(model_info, text):
+        if text in model_info.name.lower() or text in (model_info.description or '').lower():
+            return True
+        return any(text in p.name.lower() for p in model_info.parameters)
+
+    def _get_path(self, name):
+        if not name in self._names:
+            raise ValueError(name)
+        return self._names[name]
+
+    # model instantiation
+    def get_factory(self, name): # returns factory of model "name" (library is loaded on first use)
+        with self._lock:
+            path    = self._get_path(name)
+            factory = self._factories.get(path)
+            if factory is None:
+                factory = self._factories[path] = PluginModelFactory(path)
+                self._start_timer()
+            self._used[path] = time.time()
+            return factory
+
+    def create_model(self, name, data=None):
+        return self.get_factory(name).create_model(data)
+
+    def close_idle(self, now=None): # unloads libraries which have no models and haven't been used for "idle_timeout" seconds
+        if self.idle_timeout is None:
+            return
+        now = now if now is not None else time.time()
+        with self._lock:
+            for path, factory in self._factories.items():
+                if (not factory._created_models) and (now - self._used[path] >= self.idle_timeout):
+                    factory.unload()
+                    del self._factories[path]
+                    del self._used[path]
+
+    def _start_timer(self):
+        if (self.idle_timeout is None) or ((self._timer is not None) and self._timer.is_alive()):
+            return
+        def run():
+            while not self._stopped.wait(self.idle_timeout / 2.0):
+                self.close_idle()
+                with self._lock:
+                    if not self._factories:
+                        self._timer = None
+                        return
+        self._timer = threading.Thread(target=run, name='PluginRegistry')
+        self._timer.daemon = True
+        self._timer.start()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import hashlib
+import numpy
+
+from PluginModel import ResultCache, _is_array
+
+#################################################################################
+## helpers
+
+# smearing matrices only depend on the resolution and are therefore shared by all models and fit iterations
+_matrices = ResultCache(64 * 1024 * 1024)
+
+def _get_digest(*items): # digest of resolution inputs (arrays are hashed by content)
+    digest = hashlib.sha1()
+    for item in items:
+        if _is_array(item):
+            digest.update(numpy.ascontiguousarray(item, dtype=numpy.float64))
+        else:
+            digest.update(repr(item))
+    return digest.digest()
+
+def _get_matrix(key, generate): # returns cached SmearingMatrix or generates it
+    matrix = _matrices.get(key)
+    if matrix is None:
+        matrix = generate()
+        _matrices.put(key, matrix, matrix.nbytes)
+    return matrix
+
+def _get_grid(points, rstep, exact=None): # shared q-grid which covers all points with a relative spacing of "rstep" (q = 0 and "exact" are kept)
+    positive = points[points > 0.0]
+    if len(positive):
+        lower = positive.min()
+        upper = positive.max()
+        count = max(int(numpy.ceil(numpy.log(upper / lower) / numpy.log1p(rstep))) + 1, 2)
+        grid  = numpy.logspace(numpy.log10(lower), numpy.log10(upper), count)
+    else:
+        grid  = numpy.empty(0)
+    if (points <= 0.0).any():
+        grid = numpy.concatenate(([0.0], grid))
+    if (exact is not None) and len(exact):
+        grid = numpy.union1d(grid, exact)
+    if len(grid) < 2: # every point needs two neighbours
+        grid = numpy.concatenate((grid, grid + 1.0))
+    return grid
+
+def _create_matrix(n, rows, points, weights, rstep, exact=None): # distributes quadrature points of every row onto a shared grid by linear interpolation
+    grid = _get_grid(points, rstep, exact)
+    j    = numpy.clip(numpy.searchsorted(grid, points) - 1, 0, len(grid) - 2)
+    t    = numpy.clip((points - grid[j]) / (grid[j + 1] - grid[j]), 0.0, 1.0)
+
+    # entries of equal (row, column) are summed up
+    keys   = numpy.concatenate((rows * len(grid) + j, rows * len(grid) + j + 1))
+    values = numpy.concatenate((weights * (1.0 - t), weights * t))
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    values = numpy.bincount(inverse, values)
+    keep   = values != 0.0
+    return SmearingMatrix(grid, keys[keep] // len(grid), keys[keep] % len(grid), values[keep], n)
+
+
+#################################################################################
+## smearing matrices
+
+class SmearingMatrix(object): # sparse matrix (coordinate form) which maps I(grid) to smeared I(q); it's shared and mustn't be modified
+    # instance
+    def __init__(self, grid, rows, columns, values, n):
+        self.grid    = grid    # q-values at which models have to be calculated
+        self.rows    = rows
+        self.columns = columns
+        self.values  = values
+        self.n       = n       # number of smeared q-values
+        self.nbytes  = sum(a.nbytes for a in (grid, rows, columns, values))
+        for array in (grid, rows, columns, values):
+            array.flags.writeable = False
+
+    # calculations
+    def apply(self, iq): # smears I(grid)
+        iq = numpy.asarray(iq, dtype=numpy.float64)
+        if len(iq) != len(self.grid):
+            raise ValueError('iq')
+        return numpy.bincount(self.rows, self.values * iq[self.columns], minlength=self.n)
+
+def pinhole(q, dq, nsigma=3.0, nodes=51, rstep=None): # gaussian resolution with standard deviation "dq" for each q
+    q  = numpy.asarray(q , dtype=numpy.float64)
+    dq = numpy.broadcast_to(numpy.asarray(dq, dtype=numpy.float64), q.shape)
+    if rstep is None: # grid resolves the narrowest relative resolution
+        relative = dq[(q > 0.0) & (dq > 0.0)] / q[(q > 0.0) & (dq > 0.0)]
+        rstep    = numpy.clip(relative.min() / 10.0, 1.0e-3, 0.01) if len(relative) else 0.01
+
+    def generate():
+        t       = numpy.linspace(-nsigma, nsigma, nodes)
+        points  = q[:, None] + dq[:, None] * t[None, :]
+        weights = numpy.repeat(numpy.exp(-0.5 * t * t)[None, :], len(q), axis=0)
+        weights[points < 0.0] = 0.0 # resolution is truncated at q = 0
+        weights[dq == 0.0]    = 0.0
+        weights[dq == 0.0, nodes // 2] = 1.0
+        weights /= weights.sum(axis=1)[:, None]
+        rows = numpy.repeat(numpy.arange(len(q)), nodes)
+        keep = weights.ravel() != 0.0
+        # rows without resolution are taken from the grid unchanged
+        return _create_matrix(len(q), rows[keep], points.ravel()[keep], weights.ravel()[keep], rstep, q[dq == 0.0])
+    return _get_matrix(('pinhole', _get_digest(q, dq, nsigma, nodes, rstep)), generate)
+
+def slit(q, length, width=0.0, nodes=51, rstep=0.01): # slit smearing: uniform over [0, length] perpendicular and [-width/2, width/2] parallel to q
+    q = numpy.asarray(q, dtype=numpy.float64)
+
+    def generate():
+        u  = numpy.linspace(0.0, length, nodes) if length > 0.0 else numpy.zeros(1)
+        wu = numpy.ones(len(u))
+        if len(u) > 1: # trapezoidal rule
+            wu[0] = wu[-1] = 0.5
+        v  = numpy.linspace(-0.5 * width, 0.5 * width, nodes) if width > 0.0 else numpy.zeros(1)
+        wv = numpy.ones(len(v))
+        if len(v) > 1:
+            wv[0] = wv[-1] = 0.5
+
+        qv      = numpy.abs(q[:, None] + v[None, :])                                  # (nq, nv)
+        points  = numpy.sqrt(qv[:, :, None] ** 2 + u[None, None, :] ** 2).reshape(len(q), -1)
+        weights = numpy.repeat((wv[:, None] * wu[None, :]).reshape(1, -1), len(q), axis=0)
+        weights /= weights.sum(axis=1)[:, None]
+        rows = numpy.repeat(numpy.arange(len(q)), points.shape[1])
+        return _create_matrix(len(q), rows, points.ravel(), weights.ravel(), rstep)
+    return _get_matrix(('slit', _get_digest(q, length, width, nodes, rstep)), generate)
+
+
+#################################################################################
+## pipeline stage
+
+def smear(model, matrix, out=None): # calculates model once on the grid of "matrix" and smears the result
+    iq = matrix.apply(model.calculate_q(matrix.grid))
+    if out is not None:
+        out[:] = iq
+        return out
+    return iq
+
+class SmearedModel(object): # wraps PluginModel; calculate_q returns smeared I(q) for the q-values of the smearing matrix
+    # instance
+    def __init__(self, model, matrix, q=None):
+        self.model  = model
+        self.matrix = matrix
+        self.q      = None if q is None else numpy.array(q, dtype=numpy.float64) # q-values which have been used to build "matrix" (optional check)
+
+    # model information
+    @property
+    def model_info(self):
+        return self.model.model_info
+
+    @property
+    def parameters(self):
+        return self.model.parameters
+
+    def get_model_info(self):
+        return self.model.get_model_info()
+
+    # calculations
+    def calculate_q(self, q=None, out=None):
+        if (q is not None) and (self.q is not None) and not numpy.array_equal(q, self.q):
+            raise ValueError('q')
+        if (q is not None) and (len(q) != self.matrix.n):
+            raise ValueError('q')
+        return smear(self.model, self.matrix, out)
+
+    def calculate_q_batch(self, q, parameter_sets, out=None): # smears I(grid) of every parameter set
+        if (q is not None) and (len(q) != self.matrix.n):
+            raise ValueError('q')
+        iq     = numpy.asarray(self.model.calculate_q_batch(self.matrix.grid, parameter_sets))
+        result = numpy.array([self.matrix.apply(row) for row in iq]).reshape(len(iq), self.matrix.n)
+        if out is not None:
+            out[...] = result
+            return out
+        return result
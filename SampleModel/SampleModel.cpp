@@ -35,7 +35,7 @@ bool update_model(void* ptr, void** p) {
 
     // update model
     ParameterInfo* param_info = param_infos;
-    while (param_info->Name != NULL) {
+    while (param_info != param_infos + GetParameterCount(param_infos)) {
         if (*p == NULL)
             return false;
 
@@ -84,7 +84,7 @@ CExport void* create_model(void* data) { // "data" is only provided if associate
 
     // update description after construction of model
     ParameterInfo* param_info = param_infos;
-    while (param_info->Name != NULL) {
+    while (param_info != param_infos + GetParameterCount(param_infos)) {
         if (model_params->has_min)
             param_info->DispMin = model_params->min;
         else
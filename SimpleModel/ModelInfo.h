@@ -31,6 +31,11 @@ enum ParameterFlags {
     PF_Repeated     = 0x40,
 };
 
+enum ModelFlags {
+    MF_None         = 0x00,
+    MF_Reentrant    = 0x01, // calculate_* functions may be called concurrently (for the same or different c-models)
+};
+
 struct ParameterInfo {
 	// fields
     char*   Name;
@@ -51,14 +56,16 @@ struct ModelInfo {
     char*           ModelDescription;
     size_t          ParameterCount;
     ParameterInfo*  Parameters;
+    size_t          Flags;      // since version 2
     
 	// constructor
-    ModelInfo(char* modelName, char* modelDescription, size_t parameterCount, ParameterInfo* parameters) :
-        Version(1),
+    ModelInfo(char* modelName, char* modelDescription, size_t parameterCount, ParameterInfo* parameters, size_t flags = MF_None) :
+        Version(2),
         ModelName(modelName),
         ModelDescription(modelDescription),
         ParameterCount(parameterCount),
-        Parameters(parameters) {
+        Parameters(parameters),
+        Flags(flags) {
     }
 };
 
@@ -292,4 +299,12 @@ CExport void calculate_qxqyqz(void* ptr, void* p, size_t nq, double iq[], double
 CExport double calculate_ER(void* ptr, void* p);
 CExport double calculate_VR(void* ptr, void* p);
 
+// optional exports
+CExport void calculate_q_many(void* ptr, size_t np, void* p[], size_t nq, double iq[], double q[]); // iq[np * nq]
+// prepared parameters: bind_parameters validates and parses "p" once and returns a handle (or NULL if "p" isn't valid).
+// The handle may refer to "p"; it is only used while "p" is unchanged and released before "p" is freed.
+CExport void* bind_parameters(void* ptr, void* p);
+CExport void calculate_q_bound(void* handle, size_t nq, double iq[], double q[]);
+CExport void release_parameters(void* handle);
+
 #endif // MODELINFO_H
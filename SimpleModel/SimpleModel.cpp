@@ -9,7 +9,8 @@ ModelInfo model_info(
     "SimpleModel",
     "P(q)= nonsense + bkg",
     GetParameterCount(param_infos),
-    param_infos);
+    param_infos,
+    MF_Reentrant);
 
 // model handling
 CExport void* get_model_info() {
@@ -31,6 +32,36 @@ CExport void calculate_q(void* ptr, void* p, size_t nq, double iq[], double q[])
     for (size_t i = 0; i != nq; i++)
         iq[i] = q[i] * radius + bkg;
 }
+CExport void calculate_q_many(void* ptr, size_t np, void* p[], size_t nq, double iq[], double q[]) {
+    // evaluates the same q-vector for several parameter sets
+    for (size_t i = 0; i != np; i++)
+        calculate_q(ptr, p[i], nq, iq + i * nq, q);
+}
+
+// prepared parameters
+struct SimpleBinding {
+    double radius;
+    double bkg;
+};
+CExport void* bind_parameters(void* ptr, void* p) {
+	Parameters parameters(p);
+	if (!parameters.valid(model_info))
+		return NULL;
+
+    SimpleBinding* binding = new SimpleBinding;
+    binding->radius = parameters[0];
+    binding->bkg    = parameters[1];
+    return binding;
+}
+CExport void calculate_q_bound(void* handle, size_t nq, double iq[], double q[]) {
+    const SimpleBinding* binding = (const SimpleBinding*)handle;
+    for (size_t i = 0; i != nq; i++)
+        iq[i] = q[i] * binding->radius + binding->bkg;
+}
+CExport void release_parameters(void* handle) {
+    delete (SimpleBinding*)handle;
+}
+
 CExport double calculate_ER(void* ptr, void* p) {
 	Parameters parameters(p);
 	if (!parameters.valid())
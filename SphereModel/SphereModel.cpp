@@ -1,5 +1,7 @@
 #include "ModelInfo.h"
 #include <math.h>       /* cos */
+#include <string.h>     /* strcmp */
+#include <vector>
 
 #ifndef M_PI
 #define M_PI 3.14159265358979323846
@@ -18,79 +20,174 @@ ModelInfo model_info(
     "Sphere",
     "P(q)= analytic sphere + bkg",
     GetParameterCount(param_infos),
-    param_infos);
-
-// model handling
-CExport void* get_model_info() {
-    return &model_info;
-}
+    param_infos,
+    MF_Reentrant);
 
+// universal sphere amplitude 3 (sin(x) - x cos(x)) / x^3 (is 1 for x = 0)
 // Modified from sphere form calculator from libigor
-// scale and bkg moved to caller
-double SphereForm(double radius, double delrho, double q) {
-    double bes, f, vol, f2, qr;
-
-    //handle qr==0 separately
-    qr = q * radius;
-    if(qr == 0.0)
-        bes = 1.0;
-    else
-        bes = 3.0*(sin(qr)-qr*cos(qr))/(qr*qr*qr);
-        
-    vol = 4.0*M_PI/3.0*radius*radius*radius;
-    f   = vol*bes*delrho;       // [=] A-1
-
-    // normalize to single particle volume, convert to 1/cm
-    f2 = f * f / vol * 1.0e8;   // [=] 1/cm
-        
-    return f2;
+inline double SphereAmplitude(double x) {
+    if (x == 0.0)
+        return 1.0;
+    return 3.0*(sin(x)-x*cos(x))/(x*x*x);
 }
 
-// calculations
-CExport void calculate_q(void* ptr, void* p, size_t nq, double iq[], double q[]) {
-    Parameters parameters(p);
-
-//  if (!parameters.valid())
-//      return;
+// tabulated amplitude (optional, see create_model); linear interpolation has an absolute error below 1e-6
+const double AmplitudeTableStep = 1.0 / 256.0;
+const size_t AmplitudeTableSize = 256 * 256 + 2;    // covers 0 <= x < 256, amplitude is calculated for larger x
 
-    if (!parameters.valid(model_info))
-        return;
-    
-    const double scale      = parameters[0];
-    const double delRho     = parameters[2] - parameters[3];
-    const double background = parameters[4];
+static std::vector<double> CreateAmplitudeTable() {
+    std::vector<double> table(AmplitudeTableSize);
+    for (size_t i = 0; i != AmplitudeTableSize; i++)
+        table[i] = SphereAmplitude(i * AmplitudeTableStep);
+    return table;
+}
+static const double* GetAmplitudeTable() {
+    static const std::vector<double> table = CreateAmplitudeTable(); // created on first use and shared by all models
+    return &table[0];
+}
+inline double TabulatedAmplitude(const double* table, double x) {
+    const double t = fabs(x) * (1.0 / AmplitudeTableStep);
+    if (t >= AmplitudeTableSize - 1)
+        return SphereAmplitude(x);
+    const size_t i = (size_t)t;
+    return table[i] + (t - i) * (table[i + 1] - table[i]);
+}
 
-    // Get the dispersion points for the radius
-    const PolydisperseParameter& radius = parameters[1];
+// c-models only hold the evaluation mode
+struct SphereOptions {
+    bool tabulate;
+};
+static SphereOptions tabulated_options = { true };
 
-    // Perform the computation, with all weight points
-    double sum  = 0.0;
-    double norm = 0.0;
-    double vol  = 0.0;
+// model handling
+CExport void* get_model_info() {
+    return &model_info;
+}
+CExport void* create_model(void* data) { // create_model("tabulate") interpolates the sphere amplitude from a table
+    // "data" is NULL or a string (PluginModelFactory.create_model doesn't pass numbers)
+    if ((data != NULL) && (strcmp((const char*)data, "tabulate") == 0)) {
+        GetAmplitudeTable();
+        return &tabulated_options;
+    }
+    return NULL;
+}
+CExport void destroy_model(void* ptr) {
+    // options are static
+}
 
-    // Loop over radius weight points
-    for (size_t i = 0; i < nq; i++) {
-        const double qi = q[i];
-        
-        for(size_t ri = 0; ri < radius.npoints; ri++) {
-            const double& r = radius.values[ri];
-            const double& w = radius.weights[ri];
+// I(q) = scale * factor * sum(c_k * A(q r_k)^2) + background with c_k = w_k r_k^6,
+// i.e. all quantities which only depend on the polydispersity points are calculated once per call
+class SphereKernel {
+private:
+    // fields
+    double              _scale;
+    double              _background;
+    double              _factor;    // contrast, volume and normalization
+    double              _sum;       // sum of c_k (I(0))
+    std::vector<double> _radii;     // points with non-zero contribution
+    std::vector<double> _coefs;
+    const double*       _table;     // NULL if amplitude is calculated
+
+public:
+    // initialization
+    bool setup(void* ptr, void* p) {
+        Parameters parameters(p);
+        if (!parameters.valid(model_info))
+            return false;
+
+        const double delRho = parameters[2] - parameters[3];
+        const PolydisperseParameter& radius = parameters[1];
+
+        _scale      = parameters[0];
+        _background = parameters[4];
+        _table      = ((ptr != NULL) && ((SphereOptions*)ptr)->tabulate) ? GetAmplitudeTable() : NULL;
+
+        double norm = 0.0;
+        double vol  = 0.0;
+        _sum = 0.0;
+        _radii.reserve(radius.npoints);
+        _coefs.reserve(radius.npoints);
+        for (size_t ri = 0; ri < radius.npoints; ri++) {
+            const double r  = radius.values[ri];
+            const double w  = radius.weights[ri];
+            const double r3 = r * r * r;
+            const double c  = w * r3 * r3;
+
+            vol  += w * r3;
+            norm += w;
+            if (c != 0.0) {
+                _radii.push_back(r);
+                _coefs.push_back(c);
+                _sum += c;
+            }
+        }
 
-            //Un-normalize SphereForm by volume
-            sum += w * SphereForm(r, delRho, qi) * (r * r * r);
+        // normalize to average particle volume, convert to 1/cm
+        _factor = delRho * delRho * (4.0 * M_PI / 3.0) * 1.0e8;
+        _factor /= ((vol != 0.0) && (norm != 0.0)) ? vol : norm;
+        return true;
+    }
 
-            //Find average volume
-            vol  += w  * (r * r * r);
-            norm += w;
+    // calculations
+    void calculate(size_t nq, double iq[], const double q[]) const {
+        const size_t  n = _radii.size();
+        const double* r = n ? &_radii[0] : NULL;
+        const double* c = n ? &_coefs[0] : NULL;
+        const double  f = _scale * _factor;
+
+        for (size_t i = 0; i < nq; i++) {
+            const double qi = q[i];
+
+            double sum = 0.0;
+            if (qi == 0.0)
+                sum = _sum;
+            else if (_table != NULL)
+                for (size_t k = 0; k < n; k++) {
+                    const double a = TabulatedAmplitude(_table, qi * r[k]);
+                    sum += c[k] * a * a;
+                }
+            else
+                for (size_t k = 0; k < n; k++) {
+                    const double x = qi * r[k];
+                    const double a = 3.0 * (sin(x) - x * cos(x)) / (x * x * x);
+                    sum += c[k] * a * a;
+                }
+
+            iq[i] = f * sum + _background;
         }
+    }
+};
 
-        //Re-normalize by avg volume
-        if ((vol != 0.0) && (norm != 0.0))
-            sum /= (vol / norm);
+// calculations
+CExport void calculate_q(void* ptr, void* p, size_t nq, double iq[], double q[]) {
+    SphereKernel kernel;
+    if (!kernel.setup(ptr, p))
+        return;
 
-        iq[i] = scale * sum / norm + background;
+    kernel.calculate(nq, iq, q);
+}
+CExport void calculate_q_many(void* ptr, size_t np, void* p[], size_t nq, double iq[], double q[]) {
+    // evaluates the same q-vector for several parameter sets
+    for (size_t i = 0; i != np; i++)
+        calculate_q(ptr, p[i], nq, iq + i * nq, q);
+}
+
+// prepared parameters
+CExport void* bind_parameters(void* ptr, void* p) {
+    SphereKernel* kernel = new SphereKernel;
+    if (!kernel->setup(ptr, p)) {
+        delete kernel;
+        return NULL;
     }
+    return kernel;
+}
+CExport void calculate_q_bound(void* handle, size_t nq, double iq[], double q[]) {
+    ((const SphereKernel*)handle)->calculate(nq, iq, q);
 }
+CExport void release_parameters(void* handle) {
+    delete (SphereKernel*)handle;
+}
+
 CExport double calculate_ER(void* ptr, void* p) {
     Parameters parameters(p);
 